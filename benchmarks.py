@@ -0,0 +1,180 @@
+import re
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+
+import configuration as cfg
+import sheet_uploader as su
+import categoriser
+
+BENCHMARKS = {}
+LEGACY_PRICE_TO_SHARE_FORMULA = '=INDIRECT("R[0]C[-2]", FALSE) * INDIRECT("R[0]C[-1]",FALSE)'
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__.replace('bench_', '')] = fn
+    return fn
+
+
+def timed(label, fn, *args, repeat=3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<40} {best * 1000:10.1f} ms")
+    return result
+
+
+def synthetic_card_data(nb_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp(2020, 1, 1) + pd.to_timedelta(rng.integers(0, 365, nb_rows), unit='D')
+    return pd.DataFrame({
+        "Transaction Date": dates.strftime(su.STATEMENT_DATE_FORMAT),
+        "Post Date": dates.strftime(su.STATEMENT_DATE_FORMAT),
+        "Description": pd.Series(["AMAZON MKTPLACE", "WHOLEFDS MKT", "UBER TRIP", "SHELL OIL", "NETFLIX.COM",
+                                  "TRADER JOE'S", "STARBUCKS", "COMCAST"])[rng.integers(0, 8, nb_rows)].values,
+        "Category": pd.Series(["Shopping", "Groceries", "Travel", "Gas", "Entertainment",
+                               "Food & Drink", "Bills & Utilities"])[rng.integers(0, 7, nb_rows)].values,
+        "Type": "Sale",
+        "Amount": -rng.uniform(1, 500, nb_rows).round(2),
+        "Memo": "",
+    })
+
+
+def synthetic_statements(nb_statements, rows_per_statement):
+    statements = []
+    for i in range(nb_statements):
+        account = cfg.Account(f"CARD_{i}", {"account_type": "CreditCard", "alias": f"card_{i}", "last_4_digits": f"{i:04d}"})
+        statement = su.CreditCardStatement(account, "")
+        statement.data = synthetic_card_data(rows_per_statement, seed=i)
+        statement.load = lambda: None
+        statements.append(statement)
+    return statements
+
+
+def legacy_statements_to_dataframe(statements):
+    # frame assembly as it was before statements_to_dataframe: lists built per row, frame grown per statement
+    df = pd.DataFrame(columns=su.DF_COLUMNS)
+    for s in statements:
+        data = s.data
+        dff = pd.DataFrame(columns=[su.DF_COL_DATE, su.DF_COL_ITEM, su.DF_COL_CATEGORY, su.DF_COL_PRICE])
+        nb_rows = len(data)
+        dff[su.DF_COL_ACCOUNT] = pd.Series([str(s.account)] * nb_rows)
+        dff[su.DF_COL_DATE] = data["Transaction Date"]
+        dff[su.DF_COL_ITEM] = data["Description"]
+        dff[su.DF_COL_CATEGORY] = data["Category"]
+        dff[su.DF_COL_PRICE] = data["Amount"] * -1
+        dff[su.DF_COL_FACTOR] = pd.Series([0] * nb_rows)
+        dff[su.DF_COL_PRICE_TO_SHARE] = pd.Series([LEGACY_PRICE_TO_SHARE_FORMULA] * nb_rows)
+        df = pd.concat([df, dff])
+    return df
+
+
+@benchmark
+def bench_statement_frames(nb_statements=240, rows_per_statement=500):
+    statements = synthetic_statements(nb_statements, rows_per_statement)
+    print(f"{nb_statements} statements x {rows_per_statement} rows")
+    timed("legacy append loop", legacy_statements_to_dataframe, statements)
+    df = timed("statements_to_dataframe", su.statements_to_dataframe, statements)
+    print(f"{'memory (MB)':<40} {df.memory_usage(deep=True).sum() / 1e6:10.1f}")
+
+
+def synthetic_rules():
+    rules = [{"pattern": p, "category": f"rule_{i}", "share_factor": 0.5}
+             for i, p in enumerate(["WHOLEFDS", "TRADER JOE", r"NETFLIX\.COM", "COMCAST", "SHELL OIL",
+                                    r"AMAZON MKTPLACE #1\d{3}", "STARBUCKS", "SPOTIFY", "PG&E", "VERIZON"])]
+    rules.append({"pattern": "UBER", "max_amount": 15, "category": "Commute", "share_factor": 0})
+    rules.append({"min_amount": 400, "accounts": ["card_0"], "category": "Large purchase"})
+    return [cfg.CategorisationRule(r) for r in rules]
+
+
+def row_by_row_categorise(rules, df):
+    # what applying the rules in python looks like, every pattern searched on every row
+    patterns = [re.compile(r.pattern, re.IGNORECASE) if r.pattern else None for r in rules]
+    categories = []
+    factors = []
+    for item, price, account, category, factor in zip(df[su.DF_COL_ITEM], df[su.DF_COL_PRICE], df[su.DF_COL_ACCOUNT],
+                                                      df[su.DF_COL_CATEGORY], df[su.DF_COL_FACTOR]):
+        for rule, pattern in zip(rules, patterns):
+            if pattern and not pattern.search(item):
+                continue
+            if rule.min_amount is not None and price < rule.min_amount:
+                continue
+            if rule.max_amount is not None and price > rule.max_amount:
+                continue
+            if rule.accounts and account.split('-')[0] not in rule.accounts:
+                continue
+            category = rule.category if rule.category is not None else category
+            factor = rule.share_factor if rule.share_factor is not None else factor
+            break
+        categories.append(category)
+        factors.append(factor)
+    return categories, factors
+
+
+@benchmark
+def bench_categorisation(nb_rows=100000):
+    statements = synthetic_statements(1, nb_rows)
+    df = su.statements_to_dataframe(statements)
+    # store numbers make most descriptions distinct, as they are in real statements
+    store_numbers = pd.Series(np.random.default_rng(0).integers(0, 10000, nb_rows)).astype(str)
+    df[su.DF_COL_ITEM] = df[su.DF_COL_ITEM] + " #" + store_numbers.values
+    rules = synthetic_rules()
+    print(f"{nb_rows} rows, {df[su.DF_COL_ITEM].nunique()} distinct descriptions, {len(rules)} rules")
+    categories, factors = timed("row by row", row_by_row_categorise, rules, df, repeat=1)
+    result = timed("RuleSet.apply", categoriser.RuleSet(rules, {s.account.name: s.account for s in statements}).apply, df)
+    assert result[su.DF_COL_CATEGORY].astype('object').tolist() == [str(c) for c in categories]
+    assert np.allclose(result[su.DF_COL_FACTOR].values, factors)
+
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import chazeets
+imported = time.perf_counter()
+painted = None
+try:
+    window = chazeets.create_window(chazeets.cfg.get_configuration(), chazeets.dt.datetime(2020, 1, 1), chazeets.dt.datetime(2020, 1, 31))
+    window.read(timeout=0)
+    painted = time.perf_counter()
+    window.close()
+except Exception as e:
+    print(f"no first paint: {e}", file=sys.stderr)
+heavy = [m for m in ('pandas', 'pygsheets', 'selenium', 'splitwise') if m in sys.modules]
+print(imported - start, painted - start if painted else -1, ','.join(heavy))
+"""
+
+
+@benchmark
+def bench_startup(repeat=5):
+    # a fresh interpreter per run, module caches would hide the import time otherwise
+    best_import = best_paint = None
+    heavy = ''
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, text=True, check=True).stdout.split()
+        import_s, paint_s = float(out[0]), float(out[1])
+        heavy = out[2] if len(out) > 2 else ''
+        best_import = import_s if best_import is None else min(best_import, import_s)
+        if paint_s >= 0:
+            best_paint = paint_s if best_paint is None else min(best_paint, paint_s)
+    print(f"{'import chazeets':<40} {best_import * 1000:10.1f} ms")
+    if best_paint is None:
+        print(f"{'first paint':<40} {'no display':>13}")
+    else:
+        print(f"{'first paint':<40} {best_paint * 1000:10.1f} ms")
+    print(f"{'heavy modules loaded':<40} {heavy or 'none':>13}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', choices=[[]] + list(BENCHMARKS), help="benchmarks to run, all by default")
+    args = parser.parse_args()
+    for name in args.names or BENCHMARKS:
+        print(f"--- {name}")
+        BENCHMARKS[name]()
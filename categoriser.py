@@ -0,0 +1,139 @@
+import re
+import logging
+import numpy as np
+import pandas as pd
+
+import configuration as cfg
+
+# Date	Item	category	price		share factor	price to share
+DF_COL_ACCOUNT = "Account"
+DF_COL_DATE = "Date"
+DF_COL_ITEM = "Item"
+DF_COL_CATEGORY = "Category"
+DF_COL_PRICE = "Price"
+DF_COL_FACTOR = "Share Factor"
+DF_COL_PRICE_TO_SHARE = "Price to share"
+DF_COLUMNS = [DF_COL_ACCOUNT, DF_COL_DATE, DF_COL_ITEM, DF_COL_CATEGORY, DF_COL_PRICE, DF_COL_FACTOR, DF_COL_PRICE_TO_SHARE]
+
+# name of the group wrapping the pattern of a rule in the combined regex, followed by the index of the rule
+RULE_GROUP_PREFIX = "_r"
+
+
+class RuleSet:
+    # the first rule applying to a transaction sets its category and share factor. Patterns of a range of rules are
+    # compiled into a single alternation of named groups searched once per distinct description, a hit on a rule only leaves
+    # the rules before it to check. Amount and account constraints are column masks
+    def __init__(self, rules, accounts=None):
+        self.rules = list(rules)
+        self._accounts = [self._resolve_accounts(r.accounts, accounts or {}) for r in self.rules]
+        self._matchers = {}
+        self._rule_indexes = {f"{RULE_GROUP_PREFIX}{i}": i for i in range(len(self.rules))}
+        # rules without pattern match any description, the first of them from each rule on bounds the search
+        self._next_catch_all = [len(self.rules)] * (len(self.rules) + 1)
+        for i in reversed(range(len(self.rules))):
+            self._next_catch_all[i] = i if not self.rules[i].pattern else self._next_catch_all[i + 1]
+
+    @staticmethod
+    def _resolve_accounts(names, accounts):
+        # rules name accounts by their key in chase_accounts or their alias, frames hold str(account)
+        if not names:
+            return None
+        resolved = set()
+        for name in names:
+            matches = [str(a) for key, a in accounts.items() if name in (key, a.alias, str(a))]
+            if not matches:
+                logging.warning(f"Categorisation rule refers to unknown account '{name}'")
+            resolved.update(matches or [name])
+        return resolved
+
+    def _matcher(self, lo, hi):
+        alternatives = [f"(?P<{RULE_GROUP_PREFIX}{i}>{self.rules[i].pattern})" for i in range(lo, hi) if self.rules[i].pattern]
+        self._matchers[lo, hi] = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+        return self._matchers[lo, hi]
+
+    def _first_match(self, text, lo):
+        # index of the first rule from lo whose pattern is found in text, len(rules) when there is none. Nothing before
+        # a hit matches the rules ahead of it, only the rest of the text is searched again for them
+        found = self._next_catch_all[lo]
+        pos = 0
+        while lo < found:
+            matcher = self._matchers[lo, found] if (lo, found) in self._matchers else self._matcher(lo, found)
+            hit = matcher.search(text, pos) if matcher else None
+            if hit is None:
+                break
+            found = self._rule_indexes[hit.lastgroup]
+            pos = hit.start() + 1
+        return found
+
+    def _constraints(self, df):
+        prices = df[DF_COL_PRICE].values
+        accounts = df[DF_COL_ACCOUNT].astype('object').values
+        masks = np.ones((len(df), len(self.rules) + 1), dtype=bool)
+        for i, rule in enumerate(self.rules):
+            if rule.min_amount is not None:
+                masks[:, i] &= prices >= rule.min_amount
+            if rule.max_amount is not None:
+                masks[:, i] &= prices <= rule.max_amount
+            if self._accounts[i] is not None:
+                masks[:, i] &= np.isin(accounts, list(self._accounts[i]))
+        return masks
+
+    def match(self, df):
+        # index of the winning rule for each row, -1 when none applies
+        nb_rows = len(df)
+        if not self.rules or not nb_rows:
+            return np.full(nb_rows, -1)
+        codes, uniques = pd.factorize(df[DF_COL_ITEM].astype('object').fillna(''))
+        uniques = np.asarray(uniques, dtype='object')
+        masks = self._constraints(df)
+        winners = np.array([self._first_match(text, 0) for text in uniques], dtype='int64')[codes]
+        # rows failing the constraints of their rule carry on with the next rules, once per distinct description
+        failing = np.flatnonzero(~masks[np.arange(nb_rows), winners])
+        while len(failing):
+            keys, inverse = np.unique(codes[failing] * (len(self.rules) + 1) + winners[failing] + 1, return_inverse=True)
+            key_codes, key_los = np.divmod(keys, len(self.rules) + 1)
+            # rules without pattern right after the failing one need no search
+            found = np.take(self._next_catch_all, key_los)
+            searched = np.flatnonzero(key_los < found)
+            found[searched] = [self._first_match(uniques[code], lo)
+                               for code, lo in zip(key_codes[searched], key_los[searched].tolist())]
+            winners[failing] = found[inverse]
+            failing = failing[~masks[failing, winners[failing]]]
+        winners[winners == len(self.rules)] = -1
+        return winners
+
+    def apply(self, df):
+        winners = self.match(df)
+        matched = winners >= 0
+        if not matched.any():
+            return df
+        df = df.copy()
+        categories = np.array([r.category for r in self.rules], dtype='object')
+        factors = np.array([np.nan if r.share_factor is None else r.share_factor for r in self.rules], dtype='float64')
+
+        new_categories = categories[winners[matched]]
+        has_category = pd.notna(new_categories)
+        if has_category.any():
+            category = df[DF_COL_CATEGORY].astype('object').to_numpy(copy=True)
+            category[np.flatnonzero(matched)[has_category]] = new_categories[has_category]
+            df[DF_COL_CATEGORY] = pd.Categorical(category)
+
+        new_factors = factors[winners[matched]]
+        has_factor = ~np.isnan(new_factors)
+        if has_factor.any():
+            factor = df[DF_COL_FACTOR].to_numpy(dtype='float64', copy=True)
+            factor[np.flatnonzero(matched)[has_factor]] = new_factors[has_factor]
+            df[DF_COL_FACTOR] = factor
+        logging.info(f"Categorisation rules matched {int(matched.sum())} of {len(df)} transaction(s)")
+        return with_price_to_share(df)
+
+
+def with_price_to_share(df):
+    df[DF_COL_PRICE_TO_SHARE] = df[DF_COL_PRICE] * df[DF_COL_FACTOR]
+    return df
+
+
+def get_rule_set(config: cfg.Configuration):
+    if not config.categorisation_rules:
+        return None
+    return RuleSet(config.categorisation_rules, config.chase_accounts)
@@ -0,0 +1,82 @@
+import os
+import datetime as dt
+import logging
+import tempfile
+import requests
+from requests.adapters import HTTPAdapter
+
+import configuration as cfg
+from download_watcher import move_without_overwrite
+
+# same form the "Download" button posts, answered with the CSV file
+CHASE_EXPORT_URL = "https://secure01b.chase.com/svc/rr/accounts/secure/v1/account/activity/download/list"
+
+DATE_FORMAT = '%m/%d/%Y'
+CHUNK_SIZE = 64 * 1024
+
+
+class ExportError(Exception):
+    pass
+
+
+def statement_filename(account: cfg.Account, date_from: dt.datetime, date_to: dt.datetime, download_date: dt.datetime):
+    # the names chase gives to card statements. Chase leaves the range out for checking accounts, exports of two
+    # months made the same day would share a name and the range would have to be guessed from the content
+    return f"Chase{account.last_4_digits}_Activity{date_from:%Y%m%d}_{date_to:%Y%m%d}_{download_date:%Y%m%d}.CSV"
+
+
+class ChaseExporter:
+    def __init__(self, download_dir, export_url=CHASE_EXPORT_URL, pool_size=4, timeout_s=30):
+        self.download_dir = download_dir
+        self.export_url = export_url
+        self.timeout_s = timeout_s
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def load_session(self, cookies, user_agent=None):
+        self.session.cookies.clear()
+        for cookie in cookies:
+            self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'), path=cookie.get('path', '/'))
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+
+    def export_statement(self, account: cfg.Account, date_from, date_to):
+        logging.info(f"Exporting statement for account {account.alias} from {date_from} to {date_to}")
+        account_id = account.url_param.split(',')[-1]
+        form = {
+            "accountId": account_id,
+            "filterTranType": "ALL",
+            "statementPeriodId": "ALL",
+            "downloadType": "CSV",
+            "dateLo": date_from,
+            "dateHi": date_to,
+        }
+        with self.session.post(self.export_url, data=form, stream=True, timeout=self.timeout_s) as response:
+            response.raise_for_status()
+            if 'html' in response.headers.get('Content-Type', ''):
+                raise ExportError(f"Export for {account.alias} answered with a page instead of a CSV, session probably expired")
+            filename = statement_filename(account, dt.datetime.strptime(date_from, DATE_FORMAT),
+                                          dt.datetime.strptime(date_to, DATE_FORMAT), dt.datetime.today())
+            return self._save(response, filename)
+
+    def _save(self, response, filename):
+        os.makedirs(self.download_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.download_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+            return move_without_overwrite(tmp_path, self.download_dir, filename)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def get_exporter(config: cfg.Configuration):
+    if not config.chase_direct_export:
+        return None
+    return ChaseExporter(config.statements_download_dir, config.chase_export_url or CHASE_EXPORT_URL,
+                         max(4, config.scraper_pool_size))
+
@@ -1,17 +1,32 @@
+import os
 import time
+import queue
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+import requests
 
 import configuration as cfg
+from chase_exporter import ExportError, get_exporter
+from download_watcher import DownloadWatcher, PendingDownload
+from session_store import get_session_store
 
 # need to hack chrome driver to avoid bot detection
 # https://stackoverflow.com/questions/33225947/can-a-website-detect-when-you-are-using-selenium-with-chromedriver/41904453#41904453
 
 
 DEFAULT_DRIVER_PATH = './chromedriver'
+DEFAULT_DOWNLOAD_DIR = os.path.expanduser('~/Downloads')
 
 CHASE_LOGIN_URL = "https://secure01b.chase.com/web/auth"
+CHASE_DOMAIN_URL = "https://secure01b.chase.com/"
+CHASE_DASHBOARD_URL = "https://secure01b.chase.com/web/auth/dashboard"
 CHASE_STATEMENTS_URL = "https://secure01b.chase.com/web/auth/dashboard#/dashboard/accountServicing/downloadAccountTransactions/index;params="
 
 INPUT_LOGON_USERNAME_ID = 'userId-text-input-field'
@@ -28,70 +43,331 @@ BUTTON_DOWNLOAD_OTHER_ID = 'downloadOtherActivity'
 
 DATE_FORMAT = '%m/%d/%Y'
 
+WORKER_DIR_PREFIX = ".worker"
+
+BLOCKED_MEDIA_URLS = ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.webp", "*.ico",
+                      "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+                      "*.mp4", "*.webm", "*.mp3", "*.m4a"]
+BLOCKED_TRACKER_URLS = ["*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+                        "*omtrdc.net*", "*demdex.net*", "*adobedtm.com*", "*everesttech.net*",
+                        "*facebook.net*", "*qualtrics.com*", "*go-mpulse.net*"]
+COOKIE_KEYS = ('name', 'value', 'path', 'domain', 'secure', 'httpOnly', 'expiry', 'sameSite')
+
+DEFAULT_TIMEOUT_S = 10
+DEFAULT_POLL_S = .1
+
+# counts in-flight XHR / fetch requests. Installed by the driver before any script of a new document runs,
+# requests started before the hooks would never be counted
+JS_REQUEST_TRACKER = """
+(function() {
+    if (window.__chazeetsXhr) {
+        return;
+    }
+    var tracker = window.__chazeetsXhr = {pending: 0};
+    var send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function() {
+        tracker.pending++;
+        this.addEventListener('loadend', function() { tracker.pending--; });
+        return send.apply(this, arguments);
+    };
+    if (window.fetch) {
+        var fetch = window.fetch;
+        window.fetch = function() {
+            tracker.pending++;
+            return fetch.apply(this, arguments).finally(function() { tracker.pending--; });
+        };
+    }
+})();
+"""
+JS_PENDING_REQUESTS = JS_REQUEST_TRACKER + """
+return [window.__chazeetsXhr.pending + (window.jQuery ? window.jQuery.active : 0),
+        performance.getEntriesByType('resource').length];
+"""
+
+
+def statement_file_pattern(account: cfg.Account):
+    return f"Chase{account.last_4_digits}_Activity*.CSV"
+
+
+class WaitTimeout(Exception):
+    def __init__(self, step, timeout_s):
+        super().__init__(f"Timed out after {timeout_s}s waiting for {step}")
+        self.step = step
+        self.timeout_s = timeout_s
+
+
+class Waiter:
+    def __init__(self, driver, timeout_s=DEFAULT_TIMEOUT_S, poll_s=DEFAULT_POLL_S):
+        self.driver = driver
+        self.timeout_s = timeout_s
+        self.poll_s = poll_s
+
+    def until(self, step, condition, timeout_s=None):
+        timeout_s = self.timeout_s if timeout_s is None else timeout_s
+        start = time.time()
+        try:
+            result = WebDriverWait(self.driver, timeout_s, poll_frequency=self.poll_s).until(condition)
+        except TimeoutException:
+            logging.error(f"Timed out after {timeout_s}s waiting for {step}")
+            raise WaitTimeout(step, timeout_s)
+        logging.debug(f"{step} after {time.time() - start:.2f}s")
+        return result
+
+    def present(self, locator, step=None, timeout_s=None):
+        return self.until(step or f"presence of {locator}", EC.presence_of_element_located(locator), timeout_s)
+
+    def clickable(self, locator, step=None, timeout_s=None):
+        return self.until(step or f"{locator} to be clickable", EC.element_to_be_clickable(locator), timeout_s)
+
+    def any_present(self, locators, step=None, timeout_s=None):
+        def condition(driver):
+            for locator in locators:
+                elements = driver.find_elements(*locator)
+                if elements:
+                    return elements[0]
+            return False
+        return self.until(step or f"presence of any of {locators}", condition, timeout_s)
+
+    def page_loaded(self, step="page load", timeout_s=None):
+        return self.until(step, lambda d: d.execute_script("return document.readyState") == "complete", timeout_s)
+
+    def url_changes(self, url, step="navigation", timeout_s=None):
+        return self.until(step, EC.url_changes(url), timeout_s)
+
+    def xhr_idle(self, step="network idle", timeout_s=None):
+        # idle once nothing is in flight and no new resource was fetched since the previous poll
+        last_count = [-1]
+
+        def condition(driver):
+            pending, count = driver.execute_script(JS_PENDING_REQUESTS)
+            idle = pending == 0 and count == last_count[0]
+            last_count[0] = count
+            return idle
+        return self.until(step, condition, timeout_s)
+
+
+class BrowserSettings:
+    def __init__(self, headless=False, block_resources=False, window_size=None, blocked_urls=()):
+        self.headless = headless
+        self.block_resources = block_resources
+        self.window_size = window_size
+        self.blocked_urls = list(blocked_urls)
+
+    @staticmethod
+    def from_config(config: cfg.Configuration):
+        return BrowserSettings(config.chrome_headless, config.chrome_block_resources,
+                               config.chrome_window_size, config.chrome_blocked_urls or ())
+
+    def apply(self, options, prefs):
+        if self.headless:
+            options.add_argument("--headless")
+            options.add_argument("--disable-gpu")
+            options.add_argument("--disable-gpu-compositing")
+        if self.headless and self.window_size:
+            # a visible window keeps the size the user gave it
+            options.add_argument(f"--window-size={self.window_size}")
+        if self.block_resources:
+            prefs["profile.managed_default_content_settings.images"] = 2
+
+    def get_blocked_urls(self):
+        if not self.block_resources:
+            return self.blocked_urls
+        return BLOCKED_MEDIA_URLS + BLOCKED_TRACKER_URLS + self.blocked_urls
+
 
 class ChaseScraper:
-    def __init__(self, driver_path=DEFAULT_DRIVER_PATH):
+    def __init__(self, driver_path=DEFAULT_DRIVER_PATH, download_dir=None, staging_dir=None, user_data_dir=None,
+                 settings: BrowserSettings = None):
+        self.download_dir = os.path.abspath(download_dir or DEFAULT_DOWNLOAD_DIR)
+        self.staging_dir = os.path.abspath(staging_dir or self.download_dir)
+        settings = settings or BrowserSettings()
         options = webdriver.ChromeOptions()
         options.add_argument("--disable-extensions")
+        if user_data_dir:
+            options.add_argument(f"--user-data-dir={user_data_dir}")
+        prefs = {
+            "download.default_directory": self.staging_dir,
+            "download.prompt_for_download": False,
+        }
+        settings.apply(options, prefs)
+        options.add_experimental_option("prefs", prefs)
         self.driver = webdriver.Chrome(options=options, executable_path=driver_path)
+        self._setup_devtools(settings)
+        self.wait = Waiter(self.driver)
+        self.downloads = DownloadWatcher(self.staging_dir, self.download_dir)
+
+    def _setup_devtools(self, settings: BrowserSettings):
+        self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": JS_REQUEST_TRACKER})
+        blocked_urls = settings.get_blocked_urls()
+        if blocked_urls:
+            self.driver.execute_cdp_cmd("Network.enable", {})
+            self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": blocked_urls})
+        if settings.headless:
+            # headless chrome drops downloads unless explicitly allowed
+            self.driver.execute_cdp_cmd("Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": self.staging_dir})
 
-    def logon(self, username, password, wait_seconds=3):
+    def logon(self, username, password, timeout_s=30):
         self.driver.get(CHASE_LOGIN_URL)
+        self.wait.page_loaded("logon page load")
         # self._find_by_id(INPUT_LOGON_USERNAME_ID).send_keys(username)
         if password:
             self._find_by_id(INPUT_LOGON_PASSWORD_ID).send_keys(password)
             self._find_by_id(INPUT_LOGON_PASSWORD_ID).submit()
-        time.sleep(wait_seconds)
+            self.wait.url_changes(CHASE_LOGIN_URL, "logon navigation", timeout_s)
+            self.wait.page_loaded("dashboard load", timeout_s)
+            self.wait.xhr_idle("dashboard network idle", timeout_s)
 
-    def quit(self, wait_seconds=5):
-        time.sleep(wait_seconds)   # give time to finish last action
+    def is_logged_on(self, timeout_s=DEFAULT_TIMEOUT_S):
+        # the dashboard bounces back to the logon form when the session has expired
+        self.driver.get(CHASE_DASHBOARD_URL)
+        try:
+            self.wait.page_loaded("session check", timeout_s)
+            self.wait.xhr_idle("session check network idle", timeout_s)
+        except WaitTimeout:
+            return False
+        return not self.driver.find_elements(By.ID, INPUT_LOGON_PASSWORD_ID)
+
+    def get_session_cookies(self):
+        return self.driver.get_cookies()
+
+    def get_user_agent(self):
+        return self.driver.execute_script("return navigator.userAgent")
+
+    def load_session_cookies(self, cookies):
+        # cookies can only be set for the domain currently loaded
+        self.driver.get(CHASE_DOMAIN_URL)
+        for cookie in cookies:
+            try:
+                self.driver.add_cookie({k: v for k, v in cookie.items() if k in COOKIE_KEYS})
+            except WebDriverException as e:
+                logging.warning(f"Could not copy cookie {cookie.get('name')}: {e}")
+
+    def quit(self, timeout_s=60):
         if self.driver:
+            if not self.downloads.wait_all(timeout_s):   # give time to finish pending downloads
+                logging.warning(f"Quitting with downloads still pending after {timeout_s}s")
             self.driver.quit()
             self.driver = None
 
     def download_statement(self, account: cfg.Account, date_from, date_to):
         logging.info(f"Retrieving statement for account {account.alias} from {date_from} to {date_to}")
         self.driver.get(CHASE_STATEMENTS_URL + account.url_param)
-        time.sleep(1)
-
-        activity_element = self._find_by_id(account.div_id)
-        activity_element.click()
-        time.sleep(.5)
+        self.wait.page_loaded(f"statements page load for {account.alias}")
 
-        date_link_element = self._find_by_xpath(DROPDOWN_DATE_RANGE_XPATH)
-        date_link_element.click()
+        self.wait.clickable((By.ID, account.div_id), f"activity dropdown for {account.alias}").click()
+        self.wait.clickable((By.XPATH, DROPDOWN_DATE_RANGE_XPATH), "date range option").click()
 
         self._find_by_id(INPUT_DATE_FROM_ID).send_keys(date_from)
         self._find_by_id(INPUT_DATE_TO_ID).send_keys(date_to)
 
-        self._find_by_id(BUTTON_DOWNLOAD_ID).click()
-        self._find_by_id(BUTTON_DOWNLOAD_OTHER_ID).click()
-        time.sleep(1)
+        download = self.downloads.expect(statement_file_pattern(account))
+        self.wait.clickable((By.ID, BUTTON_DOWNLOAD_ID), "download button").click()
+        self.wait.clickable((By.ID, BUTTON_DOWNLOAD_OTHER_ID), "download confirmation button").click()
+        return download
 
-    def _find_by_id(self, elt_id, timeout_s=10):
-        return self._find(self.driver.find_element_by_id, [elt_id], timeout_s)
+    def _find_by_id(self, elt_id, timeout_s=DEFAULT_TIMEOUT_S):
+        return self.wait.present((By.ID, elt_id), timeout_s=timeout_s)
 
-    def _find_by_ids(self, elt_id_list, timeout_s=10):
-        return self._find(self.driver.find_element_by_id, elt_id_list, timeout_s)
+    def _find_by_ids(self, elt_id_list, timeout_s=DEFAULT_TIMEOUT_S):
+        return self.wait.any_present([(By.ID, elt_id) for elt_id in elt_id_list], timeout_s=timeout_s)
 
-    def _find_by_xpath(self, xpath, timeout_s=10):
-        return self._find(self.driver.find_element_by_xpath, [xpath], timeout_s)
+    def _find_by_xpath(self, xpath, timeout_s=DEFAULT_TIMEOUT_S):
+        return self.wait.present((By.XPATH, xpath), timeout_s=timeout_s)
 
-    @staticmethod
-    def _find(finder, elt_id_list, timeout_s):
-        max_time = time.time() + timeout_s
-        item = None
-        while not item and time.time() < max_time:
-            for elt_id in elt_id_list:
-                try:
-                    item = finder(elt_id)
-                except Exception as e:
-                    pass
-            if not item:
-                time.sleep(.5)
-        if not item:
-            logging.error(f"Could not find item(s) {elt_id_list}")
-        return item
+
+class ScraperPool:
+    # one logged-in scraper whose session cookies are copied into extra drivers.
+    # Each driver downloads into its own staging directory, finished files land in download_dir
+    def __init__(self, driver_path=DEFAULT_DRIVER_PATH, download_dir=None, size=1, session_store=None,
+                 settings: BrowserSettings = None, exporter=None):
+        self.driver_path = driver_path
+        self.download_dir = os.path.abspath(download_dir or DEFAULT_DOWNLOAD_DIR)
+        self.size = max(1, size)
+        self.session_store = session_store
+        self.settings = settings
+        self.exporter = exporter
+        if exporter and not exporter.download_dir:
+            exporter.download_dir = self.download_dir
+        self.primary = self._create_scraper(0)
+        self.scrapers = [self.primary]
+        self._idle = queue.Queue()
+        self._idle.put(self.primary)
+
+    def _create_scraper(self, index):
+        # only the primary driver keeps the saved profile, chrome refuses to share one between instances
+        user_data_dir = self.session_store.profile_dir if self.session_store and index == 0 else None
+        staging_dir = os.path.join(self.download_dir, f"{WORKER_DIR_PREFIX}{index}") if self.size > 1 else None
+        return ChaseScraper(self.driver_path, self.download_dir, staging_dir, user_data_dir, self.settings)
+
+    def resume_session(self):
+        if not self.session_store:
+            return False
+        cookies = self.session_store.load_cookies()
+        if cookies:
+            self.primary.load_session_cookies(cookies)
+        return self.primary.is_logged_on()
+
+    def logon(self, username, password):
+        if self.resume_session():
+            logging.info("Reusing saved Chase session")
+        else:
+            self.primary.logon(username, password)
+        if self.session_store:
+            self.session_store.save_cookies(self.primary.get_session_cookies())
+        if self.exporter:
+            self.exporter.load_session(self.primary.get_session_cookies(), self.primary.get_user_agent())
+        missing = range(len(self.scrapers), self.size)
+        if not missing:
+            return
+        cookies = self.primary.get_session_cookies()
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            extras = list(executor.map(self._create_scraper, missing))
+            list(executor.map(lambda s: s.load_session_cookies(cookies), extras))
+        for scraper in extras:
+            self.scrapers.append(scraper)
+            self._idle.put(scraper)
+        logging.info(f"Started {len(extras)} extra scraper(s) sharing the session")
+
+    def download_statement(self, account: cfg.Account, date_from, date_to):
+        if self.exporter:
+            try:
+                path = self.exporter.export_statement(account, date_from, date_to)
+                return PendingDownload.resolved(statement_file_pattern(account), path)
+            except (requests.RequestException, ExportError, OSError) as e:
+                logging.warning(f"Direct export failed for {account.alias}, using the download page instead: {e}")
+        scraper = self._idle.get()
+        try:
+            return scraper.download_statement(account, date_from, date_to)
+        finally:
+            self._idle.put(scraper)
+
+    def download_statements(self, accounts, date_from, date_to):
+        with ThreadPoolExecutor(max_workers=len(self.scrapers)) as executor:
+            futures = {a: executor.submit(self.download_statement, a, date_from, date_to) for a in accounts}
+        downloads = {}
+        for account, future in futures.items():
+            try:
+                downloads[account] = future.result()
+            except Exception as e:
+                logging.error(f"Could not download statement for account {account}: {e}")
+        return downloads
+
+    def release(self, timeout_s=60):
+        # quits the extra drivers but keeps the primary one (and its session) warm for the next run
+        if not self.primary.downloads.wait_all(timeout_s):
+            logging.warning(f"Releasing with downloads still pending after {timeout_s}s")
+        extras = self.scrapers[1:]
+        if extras:
+            with ThreadPoolExecutor(max_workers=len(extras)) as executor:
+                list(executor.map(lambda s: s.quit(timeout_s), extras))
+        self.scrapers = [self.primary]
+        self._idle = queue.Queue()
+        self._idle.put(self.primary)
+
+    def quit(self, timeout_s=60):
+        with ThreadPoolExecutor(max_workers=len(self.scrapers)) as executor:
+            list(executor.map(lambda s: s.quit(timeout_s), self.scrapers))
+        self.scrapers = []
 
 
 if __name__ == "__main__":
@@ -105,10 +381,12 @@ if __name__ == "__main__":
 
     config = cfg.get_configuration()
 
-    scraper = ChaseScraper(config.chromedriver_path)
+    scraper = ScraperPool(config.chromedriver_path, config.statements_download_dir, config.scraper_pool_size,
+                          get_session_store(config), BrowserSettings.from_config(config), get_exporter(config))
     scraper.logon(username_, password_)
 
-    for name, account in config.chase_accounts.items():
-        scraper.download_statement(account, '01/01/2020', '01/31/2020')
+    downloads = scraper.download_statements(config.chase_accounts.values(), '01/01/2020', '01/31/2020')
+    for account, download in downloads.items():
+        print(account, download.result())
 
     scraper.quit()
@@ -1,15 +1,16 @@
 import datetime as dt
 import logging
 import threading
-import time
-import collections
 import PySimpleGUI as sg
 
 import configuration as cfg
-from chase_scraper import ChaseScraper
-from chase_scraper import DATE_FORMAT as CHASE_DATE_FORMAT
-from sheet_uploader import SheetUploader
-import splitwise_uploader as splitwise
+from scheduler import JobScheduler, LANE_PARSE, LANE_SHEETS, LANE_SPLITWISE, REQUIRE_ANY
+from job_journal import get_job_journal
+from pipeline import (FORMAT_DATE, create_scheduler, ChaseScraperWrapper, login, get_statements, connect_sheets,
+                      connect_splitwise, downloaded_paths, pending_downloads, upload_dataframe, push_expenses)
+
+# selenium, pandas, pygsheets and splitwise take most of the startup time, the modules using them are only
+# imported by the background jobs needing them
 
 KEY_DATES_FROM = "date_from-key"
 KEY_DATES_TO = "date_to-key"
@@ -22,6 +23,7 @@ KEY_CHASE_PASSWORD = "chase_password-key"
 KEY_SIGNIN = "button_signin-key"
 KEY_RUN = "button_run_key"
 KEY_PUSH = "button_push-key"
+KEY_PUSH_UPDATE = "check_push_update-key"
 KEY_RUN_ALL = "button_runall-key"
 
 KEY_SHEET_TABS = "choice_tabs-key"
@@ -29,99 +31,101 @@ KEY_SHEET_REFRESH = "button_sheet_refresh-key"
 KEY_SHEET_CONTENT = "txt_sheet_content-key"
 KEY_SPLITWISE_PUSH = "button_splitwise_push-key"
 
+KEY_STATUS = "txt_status-key"
+KEY_PROGRESS = "progress-key"
+KEY_CANCEL = "button_cancel-key"
+
+# posted by background jobs, the value is the finished job
+EVENT_JOB_DONE = "event_job_done-key"
+EVENT_SHEETS_READY = "event_sheets_ready-key"
+EVENT_SHEET_TABS = "event_sheet_tabs-key"
+EVENT_TOTALS = "event_totals-key"
+EVENT_SPLITWISE_READY = "event_splitwise_ready-key"
+# the statements run all still has to download, checked against the journal in the background
+EVENT_RUN_ALL_PENDING = "event_run_all_pending-key"
+# posted while expenses get pushed, the value is (done, total)
+EVENT_SPLITWISE_PROGRESS = "event_splitwise_progress-key"
+
 
 FONT_TITLE = ("Gill Sans Bold", 35)
 FONT_GROUP = ("Gill Sans", 25)
 FONT_TEXT = ("Gill Sans Light", 16)
 FONT_TEXT2 = ("Arial", 16)
 
-FORMAT_DATE = "%Y-%m-%d"
-
 SELECT_STR = " <select> "
 
-class BackgroundWorker:
-    scraper = None
-    thread = None
-    queue = collections.deque()
-    exit = False
-
-    def __init__(self):
-        self.thread = threading.Thread(target=self._loop, daemon=True)
-        self.thread.start()
-
-    def _loop(self):
-        while not self.exit:
-            if self.queue:
-                (action, args) = self.queue.popleft()
-                try:
-                    action(*args)
-                except Exception as e:
-                    logging.error(e)
-
-            else:
-                time.sleep(.1)
-
-    def enqueue(self, action, *args):
-        self.queue.append((action, args))
-
-
-class ChaseScraperWrapper:
-    scraper = None
-
-    def __init__(self, config: cfg.Configuration):
-        self.config = config
-
-    def get_scraper(self):
-        if not self.scraper:
-            self.scraper = ChaseScraper(self.config.chromedriver_path)
-        return self.scraper
-
-    def logon(self, username, password):
-        self.get_scraper().logon(username, password)
+class BackgroundTasks:
+    # submits jobs to the scheduler on behalf of the GUI, every finished job comes back to the event loop as a
+    # window event. Jobs submitted until all of them are done make a batch, shown in the progress bar and cancelled together
+    def __init__(self, scheduler: JobScheduler, window: sg.Window):
+        self.scheduler = scheduler
+        self.window = window
+        self.jobs = []
+        self.cancelled = threading.Event()
+
+    def submit(self, lane, action, *args, event=EVENT_JOB_DONE, **kwargs):
+        if self.jobs and all(j.done() for j in self.jobs):
+            self.jobs = []
+            self.cancelled = threading.Event()
+        job = self.scheduler.submit(lane, action, *args, **kwargs)
+        self.jobs.append(job)
+        job.add_done_callback(lambda j: self.window.write_event_value(event, j))
+        return job
+
+    def progress(self):
+        return sum(1 for j in self.jobs if j.done()), len(self.jobs)
+
+    def cancel(self):
+        # running jobs finish, the ones not started yet are dropped
+        self.cancelled.set()
+        for job in self.jobs:
+            job.cancel("Cancelled from the GUI")
+
+
+# clients are created by a job of their lane, the functions below get them from that job. Jobs of the lane run in order
+# so they find the client ready, a failed connection fails them with its error
+def upload_to_sheets(scheduler: JobScheduler, sheets_job, date_from_str, date_to_str, update=False, downloads=None,
+                     journal=None, resume=False, resumed=None):
+    # downloads are the download jobs by str(account), their statements are uploaded rather than looked up again,
+    # as well as the ones resumed from a previous run. An account failing to download does not hold back the others
+    chase_date_from = dt.datetime.strptime(date_from_str, FORMAT_DATE)
+    chase_date_to = dt.datetime.strptime(date_to_str, FORMAT_DATE)
+    downloads = downloads or {}
+    paths_job = scheduler.submit(LANE_PARSE, downloaded_paths, downloads, resumed, depends_on=list(downloads.values()),
+                                 require_success=False if resumed else REQUIRE_ANY, name=f"statements {date_from_str}")
+    return scheduler.submit(LANE_SHEETS, upload_statements, sheets_job, paths_job, chase_date_from, chase_date_to, update,
+                            journal, resume, depends_on=[sheets_job, paths_job], name=f"upload {date_from_str}")
 
-    def download_statement(self, account_id, date_from, date_to):
-        self.get_scraper().download_statement(account_id, date_from, date_to)
 
-    def close(self, timeout=0):
-        if self.scraper:
-            self.scraper.quit(timeout)
-            self.scraper = None
+def upload_statements(sheets_job, paths_job, date_from, date_to, update, journal=None, resume=False):
+    sheet_uploader = sheets_job.result()
+    df = sheet_uploader.get_statements_dataframe(date_from, date_to, paths_job.result())
+    return upload_dataframe(sheet_uploader, df, date_from, date_to, update, journal, resume)
 
 
-def login(worker: BackgroundWorker, scraper: ChaseScraperWrapper, username, password):
-    worker.enqueue(scraper.logon, username, password)
+def get_sheet_tabs(sheets_job):
+    return [SELECT_STR] + sheets_job.result().api.worksheet_titles()
 
 
-def get_statements(worker: BackgroundWorker, scraper: ChaseScraperWrapper, accounts, date_from, date_to):
-    chase_date_from = dt.datetime.strptime(date_from, FORMAT_DATE).strftime(CHASE_DATE_FORMAT)
-    chase_date_to = dt.datetime.strptime(date_to, FORMAT_DATE).strftime(CHASE_DATE_FORMAT)
-    for account in accounts:
-        worker.enqueue(scraper.download_statement, account, chase_date_from, chase_date_to)
-    worker.enqueue(scraper.close, 5)
+def refresh_sheet_tabs(sheets_job):
+    sheets_job.result().refresh()
+    return get_sheet_tabs(sheets_job)
 
 
-def upload_to_sheets(worker: BackgroundWorker, sheet_uploader: SheetUploader, date_from_str, date_to_str):
-    chase_date_from = dt.datetime.strptime(date_from_str, FORMAT_DATE)
-    chase_date_to = dt.datetime.strptime(date_to_str, FORMAT_DATE)
-    worker.enqueue(sheet_uploader.upload_statements, chase_date_from, chase_date_to, dt.datetime.today())
+def pull_totals(sheets_job, tab):
+    return sheets_job.result().pull_totals(tab)
 
 
-def get_sheet_tabs(sheet_uploader: SheetUploader):
-    return [SELECT_STR] + [w.title for w in sheet_uploader.api.sheet.worksheets()]
+def push_totals_to_splitwise(pusher_job, totals_job, tab, date, progress=None, cancelled=None, journal=None):
+    expenses = [(f"{tab} - {e.item}", e.total, date) for e in totals_job.result()]
+    return push_expenses(pusher_job.result(), tab, expenses, journal, progress=progress, cancelled=cancelled)
 
 
-def main():
-    config = cfg.get_configuration()
-    chase_scraper = ChaseScraperWrapper(config)
-    sheet_uploader = SheetUploader(config)
-    sw = splitwise.init(config)
-    background_worker = BackgroundWorker()
+def account_key(account):
+    return f"account_{account}-key"
 
-    now = dt.datetime.now()
-    first_day_of_this_month = dt.datetime(now.year, now.month, 1)
-    date_to = first_day_of_this_month - dt.timedelta(days=1)
-    date_from = dt.datetime(date_to.year, date_to.month, 1)
 
+def create_window(config: cfg.Configuration, date_from, date_to):
     sg.SetOptions(font=FONT_TEXT)
 
     # ------ Date Range Definition ------ #
@@ -154,9 +158,6 @@ def main():
         ]
     ])
 
-    def account_key(account):
-        return f"account_{account}-key"
-
     chase_accounts_frame = sg.Frame("Accounts", font=FONT_GROUP, relief=sg.RELIEF_RIDGE, layout=
     [[sg.Checkbox(account, key=account_key(key), default=True)] for key, account in config.chase_accounts.items()])
 
@@ -167,7 +168,8 @@ def main():
                    sg.Column([[sg.Text('')],
                               [sg.Button("Sign In", key=KEY_SIGNIN, size=(20, 1))],
                               [sg.Button('Download Statements', key=KEY_RUN, size=(20, 1))],
-                              [sg.Button('Export to Sheets', key=KEY_PUSH, size=(20, 1))]])],
+                              [sg.Button('Export to Sheets', key=KEY_PUSH, size=(20, 1))],
+                              [sg.Checkbox("Update existing tab", key=KEY_PUSH_UPDATE, default=True)]])],
         [sg.Button("Chase -> Sheets", size=(40, 1), key=KEY_RUN_ALL)]
     ])
 
@@ -175,9 +177,9 @@ def main():
     sg.ChangeLookAndFeel('DarkAmber')
     gsheets_frame = sg.Frame("Sheets - Splitwise", font=FONT_TITLE, relief=sg.RELIEF_FLAT, layout=
     [
-        [sg.InputOptionMenu(values=get_sheet_tabs(sheet_uploader), key=KEY_SHEET_TABS, text_color='black'), sg.Button("Refresh", key=KEY_SHEET_REFRESH)],
+        [sg.InputOptionMenu(values=[SELECT_STR], key=KEY_SHEET_TABS, text_color='black'), sg.Button("Refresh", key=KEY_SHEET_REFRESH)],
         [sg.Multiline(size=(30, 10), font=FONT_TEXT2, key=KEY_SHEET_CONTENT)],
-        [sg.Button(f"Upload to {sw.getGroup(config.splitwise_group_id).name}", size=(30, 1), key=KEY_SPLITWISE_PUSH)]
+        [sg.Button("Upload to Splitwise", size=(30, 1), key=KEY_SPLITWISE_PUSH)]
     ])
 
     # ------ XPath Frame Definition ------ #
@@ -188,15 +190,53 @@ def main():
     #     [sg.Button(button_text="Go", key='XP_FIND'), sg.Button(button_text="Click", key='XP_CLICK')]
     # ])
 
+    status_frame = sg.Frame("", relief=sg.RELIEF_FLAT, layout=
+    [
+        [sg.Text("", size=(50, 1), key=KEY_STATUS),
+         sg.ProgressBar(1, orientation='h', size=(20, 15), key=KEY_PROGRESS),
+         sg.Button("Cancel", key=KEY_CANCEL)]
+    ])
+
     layout = [
         [date_range_frame],
         [chase_frame, sg.VerticalSeparator(), gsheets_frame],
         #[chase_frame, sg.VerticalSeparator(), sg.Column([[gsheets_frame], [xpath_frame]])],
        # [sg.Text("", size=(45, 1)), sg.Button('Exit')]
+        [status_frame]
     ]
 
-    window = sg.Window("Chazeets", layout, keep_on_top=True, element_justification='center')
+    return sg.Window("Chazeets", layout, keep_on_top=True, element_justification='center', finalize=True)
+
+
+def main():
+    config = cfg.get_configuration()
+    now = dt.datetime.now()
+    first_day_of_this_month = dt.datetime(now.year, now.month, 1)
+    date_to = first_day_of_this_month - dt.timedelta(days=1)
+    date_from = dt.datetime(date_to.year, date_to.month, 1)
+
+    # the window opens right away, modules and clients needed by the features are loaded in the background
+    window = create_window(config, date_from, date_to)
+    scheduler = create_scheduler(config)
+    tasks = BackgroundTasks(scheduler, window)
+    sheets_job = tasks.submit(LANE_SHEETS, connect_sheets, config, event=EVENT_SHEETS_READY, name="sheets connect")
+    splitwise_job = tasks.submit(LANE_SPLITWISE, connect_splitwise, config, event=EVENT_SPLITWISE_READY,
+                                 name="splitwise connect")
+    chase_scraper = ChaseScraperWrapper(config)
+    chase_scraper.warm_up()
+    # every step is journaled, run all resumes from it and skips what an interrupted run already did
+    journal = get_job_journal(config)
+
+    def show_progress(text=None, done=None, total=None):
+        if done is None:
+            done, total = tasks.progress()
+        window[KEY_PROGRESS].update(current_count=done, max=max(total, 1))
+        if text is not None:
+            window[KEY_STATUS].update(value=text)
+
     curr_tab = SELECT_STR
+    # values of the window when run all was clicked, by the job checking what is left to download
+    run_all_values = {}
     while True:
         event, values = window.read(timeout=100)
         if event == '__TIMEOUT__':
@@ -205,11 +245,30 @@ def main():
                 if curr_tab == SELECT_STR:
                     window[KEY_SHEET_CONTENT].update(value="")
                 else:
-                    expenses = '\n'.join([str(e) for e in sheet_uploader.pull_totals(curr_tab)])
-                    window[KEY_SHEET_CONTENT].update(value=expenses)
+                    window[KEY_SHEET_CONTENT].update(value="Loading...")
+                    tasks.submit(LANE_SHEETS, pull_totals, sheets_job, curr_tab, event=EVENT_TOTALS, name=f"totals {curr_tab}")
             continue
         if event in (None, 'Exit'):
             break
+        if event in (EVENT_JOB_DONE, EVENT_SHEETS_READY, EVENT_SHEET_TABS, EVENT_TOTALS, EVENT_SPLITWISE_READY,
+                     EVENT_RUN_ALL_PENDING):
+            job = values[event]
+            error = f": {job.error}" if job.error else ""
+            show_progress(f"{job.name} {job.status.name.lower()}{error}")
+            if job.succeeded() and event == EVENT_SHEETS_READY:
+                tasks.submit(LANE_SHEETS, get_sheet_tabs, sheets_job, event=EVENT_SHEET_TABS, name="sheet tabs")
+            if job.succeeded() and event == EVENT_SHEET_TABS:
+                window[KEY_SHEET_TABS].update(values=job.result())
+            if job.succeeded() and event == EVENT_TOTALS and job.args[1] == curr_tab:
+                window[KEY_SHEET_CONTENT].update(value='\n'.join([str(e) for e in job.result()]))
+            if job.succeeded() and event == EVENT_SPLITWISE_READY:
+                window[KEY_SPLITWISE_PUSH].update(text=f"Upload to {job.result().group.name}")
+        if event == EVENT_SPLITWISE_PROGRESS:
+            done, total = values[event]
+            show_progress(f"Pushed {done}/{total} expense(s) to Splitwise", done, total)
+        if event == KEY_CANCEL:
+            tasks.cancel()
+            show_progress("Cancelling...")
         if event == KEY_MONTH_PREV:
             curr_df = dt.datetime.strptime(values[KEY_DATES_FROM], FORMAT_DATE)
             first_day_of_curr_month = dt.datetime(curr_df.year, curr_df.month, 1)
@@ -224,31 +283,60 @@ def main():
             date_to = dt.datetime(date_to.year, date_to.month, 1) - dt.timedelta(days=1)
             window[KEY_DATES_FROM].update(value=date_from.strftime(FORMAT_DATE))
             window[KEY_DATES_TO].update(value=date_to.strftime(FORMAT_DATE))
+        # a failed connection is attempted again by the next action needing it
+        if event in (KEY_PUSH, KEY_RUN_ALL, KEY_SHEET_REFRESH, KEY_SPLITWISE_PUSH) and sheets_job.done() and not sheets_job.succeeded():
+            sheets_job = tasks.submit(LANE_SHEETS, connect_sheets, config, event=EVENT_SHEETS_READY, name="sheets connect")
+        if event == KEY_SPLITWISE_PUSH and splitwise_job.done() and not splitwise_job.succeeded():
+            splitwise_job = tasks.submit(LANE_SPLITWISE, connect_splitwise, config, event=EVENT_SPLITWISE_READY,
+                                         name="splitwise connect")
         if event == KEY_SIGNIN:
-            login(background_worker, chase_scraper, values[KEY_CHASE_USERNAME], values[KEY_CHASE_PASSWORD])
+            login(tasks, chase_scraper, values[KEY_CHASE_USERNAME], values[KEY_CHASE_PASSWORD])
         if event == KEY_RUN:
             selected_accounts = [config.chase_accounts[account] for account in config.chase_accounts if values[account_key(account)]]
-            get_statements(background_worker, chase_scraper, selected_accounts, values[KEY_DATES_FROM], values[KEY_DATES_TO])
+            get_statements(tasks, chase_scraper, selected_accounts, values[KEY_DATES_FROM], values[KEY_DATES_TO],
+                           journal=journal)
         if event == KEY_PUSH:
-            upload_to_sheets(background_worker, sheet_uploader, values[KEY_DATES_FROM], values[KEY_DATES_TO])
+            upload_to_sheets(tasks, sheets_job, values[KEY_DATES_FROM], values[KEY_DATES_TO], values[KEY_PUSH_UPDATE],
+                             journal=journal)
         if event == KEY_RUN_ALL:
-            login(background_worker, chase_scraper, values[KEY_CHASE_USERNAME], values[KEY_CHASE_PASSWORD])
             selected_accounts = [config.chase_accounts[account] for account in config.chase_accounts if values[account_key(account)]]
-            get_statements(background_worker, chase_scraper, selected_accounts, values[KEY_DATES_FROM], values[KEY_DATES_TO])
-            upload_to_sheets(background_worker, sheet_uploader, values[KEY_DATES_FROM], values[KEY_DATES_TO])
+            # the journaled statements get hashed, which takes a while once they pile up
+            pending_job = tasks.submit(LANE_PARSE, pending_downloads, journal, selected_accounts, values[KEY_DATES_FROM],
+                                       values[KEY_DATES_TO], event=EVENT_RUN_ALL_PENDING, name="resume check")
+            run_all_values[pending_job] = dict(values)
+        if event == EVENT_RUN_ALL_PENDING:
+            pending_job = values[event]
+            run_values = run_all_values.pop(pending_job)
+            # cancelled while the journal was checked, nothing is left to cancel afterwards
+            if pending_job.succeeded() and not tasks.cancelled.is_set():
+                to_download, resumed = pending_job.result()
+                download_jobs = []
+                if to_download:
+                    logon_job = login(tasks, chase_scraper, run_values[KEY_CHASE_USERNAME], run_values[KEY_CHASE_PASSWORD])
+                    download_jobs = get_statements(tasks, chase_scraper, to_download, run_values[KEY_DATES_FROM],
+                                                   run_values[KEY_DATES_TO], depends_on=[logon_job], journal=journal)
+                upload_to_sheets(tasks, sheets_job, run_values[KEY_DATES_FROM], run_values[KEY_DATES_TO],
+                                 run_values[KEY_PUSH_UPDATE], dict(zip(map(str, to_download), download_jobs)), journal,
+                                 resume=True, resumed=resumed)
         if event == KEY_SHEET_REFRESH:
-            sheet_uploader.api.refresh()
-            window[KEY_SHEET_TABS].update(values=get_sheet_tabs(sheet_uploader))
-        if event == KEY_SPLITWISE_PUSH:
-            for e in sheet_uploader.pull_totals(curr_tab):
-                splitwise.share_expense_with_group_members(sw, f"{curr_tab} - {e.item}", e.total, config.splitwise_group_id, date_to)
+            tasks.submit(LANE_SHEETS, refresh_sheet_tabs, sheets_job, event=EVENT_SHEET_TABS, name="sheets refresh")
+        if event == KEY_SPLITWISE_PUSH and curr_tab != SELECT_STR:
+            totals_job = tasks.submit(LANE_SHEETS, pull_totals, sheets_job, curr_tab, name=f"totals {curr_tab}")
+            tasks.submit(LANE_SPLITWISE, push_totals_to_splitwise, splitwise_job, totals_job, curr_tab, date_to,
+                         lambda done, total: window.write_event_value(EVENT_SPLITWISE_PROGRESS, (done, total)), tasks.cancelled,
+                         journal, depends_on=[splitwise_job, totals_job], name=f"splitwise {curr_tab}")
+        if event in (KEY_SIGNIN, KEY_RUN, KEY_PUSH, KEY_RUN_ALL, KEY_SHEET_REFRESH, KEY_SPLITWISE_PUSH):
+            show_progress("Working...")
         if event in ("XP_FIND", "XP_CLICK"):
-            elt = chase_scraper.scraper._find_by_xpath(values['XPATH'], 1)
+            elt = chase_scraper.scraper.primary._find_by_xpath(values['XPATH'], 1)
             print(elt)
             if event == "XP_CLICK":
                 elt.click()
     window.close()
-    chase_scraper.close(0)
+    scheduler.shutdown()
+    chase_scraper.close(0, keep_spare=False)
+    if journal:
+        journal.close()
 
 
 if __name__ == "__main__":
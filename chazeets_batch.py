@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+import getpass
+import logging
+import argparse
+import datetime as dt
+
+import configuration as cfg
+from scheduler import LANE_PARSE, LANE_SHEETS, LANE_SPLITWISE, REQUIRE_ANY
+from sheet_uploader import SheetUploader
+from rate_limiter import rate_limiter_stats
+from job_journal import get_job_journal
+from pipeline import FORMAT_DATE, DOWNLOAD_TIMEOUT_S, create_scheduler, ChaseScraperWrapper, login, get_statements, \
+    connect_splitwise, downloaded_paths, pending_downloads, upload_dataframe, push_expenses
+
+MONTH_FORMAT = "%Y-%m"
+PASSWORD_ENV = "CHASE_PASSWORD"
+
+
+def parse_month(s):
+    try:
+        return dt.datetime.strptime(s, MONTH_FORMAT)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{s}' is not a month, expected YYYY-MM")
+
+
+def month_range(first, last):
+    # (first day, last day) of every month from first to last included
+    months = []
+    date_from = dt.datetime(first.year, first.month, 1)
+    while date_from <= last:
+        next_month = (date_from + dt.timedelta(days=32)).replace(day=1)
+        months.append((date_from, next_month - dt.timedelta(days=1)))
+        date_from = next_month
+    return months
+
+
+def select_accounts(config: cfg.Configuration, names):
+    # accounts are named by their key in chase_accounts, their alias or their last 4 digits
+    if not names:
+        return dict(config.chase_accounts)
+    selected = {}
+    for name in names:
+        matches = {key: a for key, a in config.chase_accounts.items() if name in (key, a.alias, a.last_4_digits)}
+        if not matches:
+            raise ValueError(f"Unknown account '{name}'")
+        selected.update(matches)
+    return selected
+
+
+def parse(sheet_uploader, downloads, resumed, date_from, date_to):
+    return sheet_uploader.get_statements_dataframe(date_from, date_to, downloaded_paths(downloads, resumed))
+
+
+def upload(sheet_uploader, parse_job, date_from, date_to, update, journal, resume):
+    return upload_dataframe(sheet_uploader, parse_job.result(), date_from, date_to, update, journal, resume)
+
+
+def pull_totals(sheet_uploader, upload_job):
+    return sheet_uploader.pull_totals(upload_job.result().title)
+
+
+def push_to_splitwise(pusher_job, upload_job, totals_job, date_to, journal, resume):
+    tab = upload_job.result().title
+    expenses = [(f"{tab} - {e.item}", e.total, date_to) for e in totals_job.result()]
+    return push_expenses(pusher_job.result(), tab, expenses, journal, resume)
+
+
+def submit_month(scheduler, sheet_uploader, scraper, accounts, date_from, date_to, logon_job, connect_job, pusher_job,
+                 update, to_download=None, journal=None, resume=False, resumed=None):
+    # every stage of a month waits for the previous one, lanes work on different months meanwhile.
+    # Accounts left out of to_download were downloaded by a previous run, resumed holds their statements.
+    # The statements downloaded get parsed, an account failing to download does not hold back the others
+    month = f"{date_from:{MONTH_FORMAT}}"
+    stages = {}
+    downloads = {}
+    if to_download is not None:
+        jobs = get_statements(scheduler, scraper, to_download, f"{date_from:{FORMAT_DATE}}", f"{date_to:{FORMAT_DATE}}",
+                              depends_on=[logon_job], close=False, journal=journal)
+        downloads = {str(a): None for a in accounts}
+        downloads.update(zip((str(a) for a in to_download), jobs))
+        stages["download"] = downloads
+    stages["parse"] = scheduler.submit(LANE_PARSE, parse, sheet_uploader, downloads, resumed, date_from, date_to,
+                                       depends_on=list(downloads.values()), require_success=False if resumed else REQUIRE_ANY,
+                                       name=f"parse {month}")
+    stages["upload"] = scheduler.submit(LANE_SHEETS, upload, sheet_uploader, stages["parse"], date_from, date_to, update,
+                                        journal, resume, depends_on=[connect_job, stages["parse"]], name=f"upload {month}")
+    stages["totals"] = scheduler.submit(LANE_SHEETS, pull_totals, sheet_uploader, stages["upload"],
+                                        depends_on=[stages["upload"]], name=f"totals {month}")
+    if pusher_job is not None:
+        stages["splitwise"] = scheduler.submit(LANE_SPLITWISE, push_to_splitwise, pusher_job, stages["upload"],
+                                               stages["totals"], date_to, journal, resume,
+                                               depends_on=[pusher_job, stages["totals"]], name=f"splitwise {month}")
+    return stages
+
+
+def job_summary(job, describe=None):
+    if job is None:   # finished by a previous run
+        return {"status": "resumed", "duration_s": None, "error": None}
+    try:
+        result = job.result()
+    except Exception:
+        result = None
+    summary = {"status": job.status.name.lower(),
+               "duration_s": round(job.duration, 2) if job.duration is not None else None,
+               "error": str(job.error) if job.error else None}
+    if job.succeeded() and describe:
+        summary.update(describe(result))
+    return summary
+
+
+STAGE_DETAILS = {
+    "parse": lambda df: {"transactions": len(df)},
+    "upload": lambda sheet: {"sheet": sheet.title},
+    "totals": lambda totals: {"totals": {e.item: e.total for e in totals}},
+    "splitwise": lambda pushed: pushed,
+}
+
+
+def summarize(months):
+    summary = []
+    for (date_from, date_to), stages in months:
+        month = {"month": f"{date_from:{MONTH_FORMAT}}", "date_from": f"{date_from:{FORMAT_DATE}}",
+                 "date_to": f"{date_to:{FORMAT_DATE}}", "stages": {}}
+        for stage, jobs in stages.items():
+            if isinstance(jobs, dict):
+                month["stages"][stage] = {account: job_summary(job) for account, job in jobs.items()}
+            else:
+                month["stages"][stage] = job_summary(jobs, STAGE_DETAILS.get(stage))
+        summary.append(month)
+    return summary
+
+
+def succeeded(summary):
+    def stage_ok(stage):
+        if "status" in stage:
+            return stage["status"] == "done"
+        return all(s["status"] in ("done", "resumed") for s in stage.values())
+    return all(stage_ok(stage) for month in summary for stage in month["stages"].values())
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Downloads Chase statements, uploads them to Google Sheets and "
+                                                 "shares the totals on Splitwise for a range of months, without the GUI")
+    parser.add_argument('first_month', type=parse_month, help="first month, YYYY-MM")
+    parser.add_argument('last_month', type=parse_month, nargs='?', help="last month included, YYYY-MM, first month by default")
+    parser.add_argument('-a', '--accounts', nargs='+', help="accounts to process, keys, aliases or last 4 digits. All by default")
+    parser.add_argument('-u', '--username', help=f"chase username, chase_username by default. The password is read from "
+                                                 f"{PASSWORD_ENV} or prompted")
+    parser.add_argument('--no-download', action='store_true', help="use the statements already downloaded")
+    parser.add_argument('--new-tab', action='store_true', help="upload to a new tab instead of updating the month tab")
+    parser.add_argument('--splitwise', action='store_true', help="push the totals of each month to the splitwise group")
+    parser.add_argument('--headless', action='store_true', help="run chrome headless")
+    parser.add_argument('--download-workers', type=int, help="browsers downloading in parallel, scraper_pool_size by default")
+    parser.add_argument('--parse-workers', type=int, default=1, help="statements parsed in parallel")
+    parser.add_argument('--splitwise-workers', type=int, help="expenses created in parallel, splitwise_push_workers by default")
+    parser.add_argument('--summary', help="write the JSON summary to this file instead of stdout")
+    parser.add_argument('--no-resume', action='store_true', help="run again the steps the journal has as finished")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = cfg.get_configuration()
+    config.chase_accounts = select_accounts(config, args.accounts)
+    if args.download_workers:
+        config.scraper_pool_size = args.download_workers
+    if args.splitwise_workers:
+        config.splitwise_push_workers = args.splitwise_workers
+    if args.headless:
+        config.chrome_headless = True
+    months = month_range(args.first_month, args.last_month or args.first_month)
+
+    started_at = time.time()
+    scheduler = create_scheduler(config, args.parse_workers)
+    sheet_uploader = SheetUploader(config)
+    # connections start right away and in parallel, the first jobs of each lane wait for them
+    connect_job = scheduler.submit(LANE_SHEETS, sheet_uploader.connect, name="sheets connect")
+    pusher_job = scheduler.submit(LANE_SPLITWISE, connect_splitwise, config, name="splitwise connect") if args.splitwise else None
+    journal = get_job_journal(config)
+    resume = journal is not None and not args.no_resume
+    accounts = list(config.chase_accounts.values())
+    # statements downloaded by a previous run are not downloaded again, chase is only logged on to when one is missing
+    to_download = [(None, {})] * len(months)
+    if not args.no_download:
+        to_download = [pending_downloads(journal if resume else None, accounts, f"{date_from:{FORMAT_DATE}}",
+                                         f"{date_to:{FORMAT_DATE}}") for date_from, date_to in months]
+    scraper = None
+    logon_job = None
+    if any(pending for pending, _ in to_download):
+        password = os.environ[PASSWORD_ENV] if PASSWORD_ENV in os.environ else getpass.getpass("Chase password: ")
+        scraper = ChaseScraperWrapper(config)
+        scraper.warm_up()
+        logon_job = login(scheduler, scraper, args.username or config.chase_username, password)
+
+    submitted = [((date_from, date_to), submit_month(scheduler, sheet_uploader, scraper, accounts, date_from, date_to,
+                                                     logon_job, connect_job, pusher_job, not args.new_tab, pending,
+                                                     journal, resume, resumed))
+                 for (date_from, date_to), (pending, resumed) in zip(months, to_download)]
+    try:
+        summary = summarize(submitted)
+    finally:
+        if scraper:
+            scraper.close(DOWNLOAD_TIMEOUT_S, keep_spare=False)
+        scheduler.shutdown()
+        if journal:
+            journal.close()
+
+    report = {"succeeded": succeeded(summary), "duration_s": round(time.time() - started_at, 2), "months": summary}
+    report["services"] = rate_limiter_stats()
+    if journal:
+        report["journal"] = journal.stats()
+    if logon_job is not None:
+        report["logon"] = job_summary(logon_job)
+        report["succeeded"] &= logon_job.succeeded()
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0 if report["succeeded"] else 1
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -28,6 +28,19 @@ class Account:
         return f"{self.alias}-{self.last_4_digits}: {self.url_param} {self.account_type}"
 
 
+class CategorisationRule:
+    def __init__(self, dico):
+        self.pattern = dico.get("pattern")
+        self.min_amount = dico.get("min_amount")
+        self.max_amount = dico.get("max_amount")
+        self.accounts = dico.get("accounts")
+        self.category = dico.get("category")
+        self.share_factor = dico.get("share_factor")
+
+    def __repr__(self):
+        return f"{self.pattern} [{self.min_amount}, {self.max_amount}] {self.accounts} -> {self.category} x{self.share_factor}"
+
+
 class Configuration:
     # make it a singleton
     _instance = None
@@ -40,14 +53,34 @@ class Configuration:
 
     chromedriver_path = None
     chase_accounts = []
+    categorisation_rules = []
     chase_username = ''
     google_credentials_path = None
     google_spreadsheet_id = None
     statements_download_dir = None
+    scraper_pool_size = 1
+    chase_session_dir = None
+    chase_session_key_path = None
+    chrome_headless = False
+    chrome_block_resources = False
+    chrome_window_size = None
+    chrome_blocked_urls = []
+    chrome_spare_idle_timeout_s = 0
+    chase_direct_export = False
+    chase_export_url = None
+    statement_cache_dir = None
+    statement_cache_max_mb = 256
+    transaction_store_path = None
+    job_journal_path = None
+    statement_chunk_size = 50000
     splitwise_key: None
     splitwise_secret: None
     splitwise_access_token: None
     splitwise_group_id: None
+    splitwise_push_workers = 4
+    sheets_requests_per_minute = 60
+    splitwise_requests_per_minute = 60
+    api_max_retries = 5
 
     def load(self, config_file_path, override_only=False):
         if not os.path.exists(config_file_path):
@@ -62,6 +95,8 @@ class Configuration:
                 else:
                     if key == "chase_accounts":
                         self.__dict__[key] = {a: Account(a, contents[key][a]) for a in contents[key]}
+                    elif key == "categorisation_rules":
+                        self.__dict__[key] = [CategorisationRule(r) for r in contents[key]]
                     else:
                         self.__dict__[key] = contents[key]
         self._loaded = True
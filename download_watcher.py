@@ -0,0 +1,216 @@
+import os
+import time
+import fnmatch
+import itertools
+import logging
+import threading
+from concurrent.futures import Future
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except (ImportError, OSError, AttributeError):
+    INotify = None
+
+PARTIAL_SUFFIX = ".crdownload"
+DEFAULT_POLL_S = .25
+DEFAULT_STABLE_CHECKS = 2
+DEFAULT_DOWNLOAD_TIMEOUT_S = 120
+
+
+def move_without_overwrite(path, directory, name=None):
+    # moves the file into directory under name, a taken name gets " (n)" appended the way chrome does.
+    # Linking fails when the target exists, two files landing at the same time cannot take the same name
+    base, ext = os.path.splitext(name or os.path.basename(path))
+    for copy in itertools.count():
+        target = os.path.join(directory, f"{base} ({copy}){ext}" if copy else f"{base}{ext}")
+        try:
+            os.link(path, target)
+        except FileExistsError:
+            continue
+        except OSError:   # no hard links on this file system
+            if os.path.exists(target):
+                continue
+            os.replace(path, target)
+            return target
+        os.remove(path)
+        return target
+
+
+class DownloadTimeout(Exception):
+    def __init__(self, pattern, timeout_s):
+        super().__init__(f"No completed download matching '{pattern}' after {timeout_s}s")
+        self.pattern = pattern
+        self.timeout_s = timeout_s
+
+
+class PendingDownload:
+    def __init__(self, pattern, known_files, timeout_s):
+        self.pattern = pattern
+        self.known_files = known_files
+        self.deadline = time.time() + timeout_s
+        self.timeout_s = timeout_s
+        self.sizes = {}
+        self.future = Future()
+
+    @staticmethod
+    def resolved(pattern, path):
+        pending = PendingDownload(pattern, {}, 0)
+        pending.future.set_result(path)
+        return pending
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def add_done_callback(self, fn):
+        self.future.add_done_callback(lambda f: fn(self))
+
+    def __repr__(self):
+        state = self.future.result() if self.done() and not self.future.exception() else "pending"
+        return f"PendingDownload({self.pattern}: {state})"
+
+
+class DownloadWatcher:
+    # watches a download directory and resolves each expected file once Chrome has finished writing it:
+    # no partial file left and the size has not changed for a few consecutive checks.
+    # Finished files are moved to destination if given (e.g. from a per-worker staging directory)
+    def __init__(self, directory, destination=None, poll_s=DEFAULT_POLL_S, stable_checks=DEFAULT_STABLE_CHECKS):
+        self.directory = directory
+        self.destination = destination
+        self.poll_s = poll_s
+        self.stable_checks = stable_checks
+        self._pending = []
+        # name -> identity of the file delivered under it. A file renamed or moved away releases its name,
+        # a new download landing under the same name is another file
+        self._claimed = {}
+        self._lock = threading.Condition()
+        self._thread = None
+
+    def expect(self, pattern, timeout_s=DEFAULT_DOWNLOAD_TIMEOUT_S):
+        os.makedirs(self.directory, exist_ok=True)
+        known = {name: self._mtime(name) for name in self._list(pattern)}
+        pending = PendingDownload(pattern, known, timeout_s)
+        with self._lock:
+            self._pending.append(pending)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+            self._lock.notify_all()
+        return pending
+
+    def wait_all(self, timeout_s=None):
+        deadline = None if timeout_s is None else time.time() + timeout_s
+        with self._lock:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+    def _loop(self):
+        notifier = self._create_notifier()
+        try:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        self._thread = None
+                        return
+                self._scan()
+                if notifier:
+                    notifier.read(timeout=int(self.poll_s * 1000))
+                else:
+                    time.sleep(self.poll_s)
+        finally:
+            if notifier:
+                notifier.close()
+
+    def _create_notifier(self):
+        if INotify is None:
+            return None
+        try:
+            notifier = INotify()
+            notifier.add_watch(self.directory, inotify_flags.CREATE | inotify_flags.CLOSE_WRITE |
+                               inotify_flags.MOVED_TO | inotify_flags.MODIFY)
+            return notifier
+        except OSError as e:
+            logging.warning(f"inotify unavailable for {self.directory}, polling instead: {e}")
+            return None
+
+    def _scan(self):
+        now = time.time()
+        with self._lock:
+            for pending in list(self._pending):
+                path = self._check(pending)
+                if path:
+                    try:
+                        pending.future.set_result(self._deliver(path))
+                    except OSError as e:
+                        pending.future.set_exception(e)
+                elif now > pending.deadline:
+                    logging.error(f"Timed out waiting for download matching '{pending.pattern}'")
+                    pending.future.set_exception(DownloadTimeout(pending.pattern, pending.timeout_s))
+                else:
+                    continue
+                self._pending.remove(pending)
+            self._lock.notify_all()
+
+    def _check(self, pending):
+        for name in self._list(pending.pattern):
+            if self._is_claimed(name) or pending.known_files.get(name, None) == self._mtime(name):
+                continue
+            if os.path.exists(os.path.join(self.directory, name + PARTIAL_SUFFIX)):
+                continue
+            size = self._size(name)
+            last_size, stable = pending.sizes.get(name, (None, 0))
+            stable = stable + 1 if size and size == last_size else 0
+            pending.sizes[name] = (size, stable)
+            if stable >= self.stable_checks:
+                self._claimed[name] = self._identity(name)
+                return os.path.join(self.directory, name)
+        return None
+
+    def _deliver(self, path):
+        if not self.destination or os.path.abspath(self.destination) == os.path.abspath(self.directory):
+            return path
+        os.makedirs(self.destination, exist_ok=True)
+        target = move_without_overwrite(path, self.destination)
+        self._claimed.pop(os.path.basename(path), None)
+        if os.path.basename(target) != os.path.basename(path):
+            logging.info(f"{os.path.basename(path)} already downloaded, kept as {os.path.basename(target)}")
+        return target
+
+    def _is_claimed(self, name):
+        if name not in self._claimed:
+            return False
+        if self._claimed[name] == self._identity(name):
+            return True
+        del self._claimed[name]
+        return False
+
+    def _list(self, pattern):
+        try:
+            return [n for n in os.listdir(self.directory) if fnmatch.fnmatch(n, pattern)]
+        except FileNotFoundError:
+            return []
+
+    def _mtime(self, name):
+        try:
+            return os.stat(os.path.join(self.directory, name)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _identity(self, name):
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _size(self, name):
+        try:
+            return os.path.getsize(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            return None
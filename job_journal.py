@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import collections
+import datetime as dt
+
+import configuration as cfg
+
+STAGE_DOWNLOAD = "download"
+STAGE_UPLOAD = "upload"
+STAGE_SPLITWISE = "splitwise"
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# key of the steps working on all the selected accounts at once
+ALL_ACCOUNTS = "*"
+
+
+class JournalStep:
+    def __init__(self, record):
+        self.stage = record["stage"]
+        self.account = record["account"]
+        self.period = record["period"]
+        self.status = record["status"]
+        self.at = dt.datetime.fromisoformat(record["at"])
+        self.digest = record.get("digest")
+        self.output = record.get("output")
+        self.error = record.get("error")
+
+    @property
+    def key(self):
+        return self.stage, self.account, self.period
+
+    def __repr__(self):
+        return f"{self.stage} {self.account} {self.period}: {self.status} at {self.at:%Y-%m-%d %H:%M:%S}"
+
+
+class JobJournal:
+    # append-only log of the steps of a run, one JSON object per line synced to disk before the step is considered
+    # finished. Steps are keyed by (stage, account, period), the last record of a key is its state. digest is the
+    # content hash of what the step produced or consumed, a step only counts as finished for the same content
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._steps = {}
+        self.resumed = collections.Counter()
+        self._load()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                step = JournalStep(json.loads(line))
+            except (ValueError, KeyError) as e:
+                # the last line is cut short when the app died while writing it
+                logging.warning(f"Ignoring line {number} of journal {self.path}: {e}")
+                continue
+            self._steps[step.key] = step
+        if lines[-1]:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write('\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def record(self, stage, account, period, status, digest=None, output=None, error=None):
+        record = {"at": dt.datetime.now().isoformat(), "stage": stage, "account": str(account), "period": period,
+                  "status": status, "digest": digest, "output": output, "error": error}
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._steps[stage, str(account), period] = JournalStep(record)
+
+    def step(self, stage, account, period):
+        with self._lock:
+            return self._steps.get((stage, str(account), period))
+
+    def finished(self, stage, account, period, digest=None, completed_after: dt.datetime = None):
+        # the step if its last run succeeded, on the same content and late enough, None when it has to run again
+        step = self.step(stage, account, period)
+        if step is None or step.status != STATUS_DONE:
+            return None
+        if digest is not None and step.digest != digest:
+            return None
+        if completed_after is not None and step.at < completed_after:
+            return None
+        return step
+
+    def skip(self, step):
+        with self._lock:
+            self.resumed[step.stage] += 1
+        logging.info(f"Skipping {step.stage} of {step.account} for {step.period}, finished at {step.at:%Y-%m-%d %H:%M:%S}")
+
+    def running(self, stage, account, period, digest=None):
+        return _RunningStep(self, stage, account, period, digest)
+
+    def stats(self):
+        with self._lock:
+            statuses = collections.Counter(step.status for step in self._steps.values())
+            return {"path": self.path, "steps": dict(statuses), "resumed": dict(self.resumed)}
+
+
+class _RunningStep:
+    # records the step as done when the block completes, as failed with the error when it raises.
+    # output and digest can be set from within the block
+    def __init__(self, journal, stage, account, period, digest):
+        self.journal = journal
+        self.key = (stage, account, period)
+        self.digest = digest
+        self.output = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None:
+            self.journal.record(*self.key, STATUS_DONE, self.digest, self.output)
+        elif isinstance(exc, Exception):
+            self.journal.record(*self.key, STATUS_FAILED, self.digest, self.output, str(exc) or type(exc).__name__)
+        return False
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def dataframe_digest(df):
+    import pandas as pd   # the GUI imports this module before pandas is needed
+    h = hashlib.sha256(json.dumps(list(map(str, df.columns))).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def content_digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def period_key(date_from: dt.datetime, date_to: dt.datetime):
+    return f"{date_from:%Y-%m-%d}..{date_to:%Y-%m-%d}"
+
+
+def get_job_journal(config: cfg.Configuration):
+    if not config.job_journal_path:
+        return None
+    return JobJournal(config.job_journal_path)
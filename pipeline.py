@@ -0,0 +1,265 @@
+import os
+import datetime as dt
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import configuration as cfg
+from statement_index import parse_statement_filename
+from scheduler import JobScheduler, LANE_BROWSER, LANE_PARSE, LANE_SHEETS, LANE_SPLITWISE
+from job_journal import (JobJournal, STAGE_DOWNLOAD, STAGE_UPLOAD, STAGE_SPLITWISE, STATUS_DONE, STATUS_FAILED,
+                         ALL_ACCOUNTS, file_digest, dataframe_digest, content_digest, period_key)
+
+# steps shared by the GUI and the batch mode, modules depending on selenium, pandas, pygsheets or splitwise
+# are imported by the functions using them so that importing this module stays cheap
+
+FORMAT_DATE = "%Y-%m-%d"
+
+DOWNLOAD_TIMEOUT_S = 120
+
+
+def create_scheduler(config: cfg.Configuration, parse_workers=1):
+    # a single sheets worker, the google client is not thread safe
+    return JobScheduler({LANE_BROWSER: config.scraper_pool_size, LANE_PARSE: parse_workers, LANE_SHEETS: 1, LANE_SPLITWISE: 1})
+
+
+class ChaseScraperWrapper:
+    scraper = None
+
+    def __init__(self, config: cfg.Configuration):
+        self.config = config
+        self._lock = threading.Lock()
+        self._holds = 0
+        self._starter = ThreadPoolExecutor(max_workers=1)
+        self._warming = None
+        self._spare_timer = None
+
+    def _create_scraper(self):
+        from chase_scraper import BrowserSettings, ScraperPool
+        from chase_exporter import get_exporter
+        from session_store import get_session_store
+        return ScraperPool(self.config.chromedriver_path, self.config.statements_download_dir,
+                           self.config.scraper_pool_size, get_session_store(self.config),
+                           BrowserSettings.from_config(self.config), get_exporter(self.config))
+
+    def warm_up(self):
+        # boots chrome in the background so the first action does not wait for it
+        with self._lock:
+            if not self.scraper and not self._warming:
+                self._warming = self._starter.submit(self._create_scraper)
+
+    def get_scraper(self):
+        # the lock is held while chrome starts so that concurrent jobs share a single pool
+        with self._lock:
+            self._cancel_spare_timer()
+            if not self.scraper and self._warming:
+                warming, self._warming = self._warming, None
+                try:
+                    self.scraper = warming.result()
+                except Exception as e:
+                    logging.error(f"Background driver startup failed: {e}")
+            if not self.scraper:
+                self.scraper = self._create_scraper()
+            return self.scraper
+
+    def logon(self, username, password):
+        self.get_scraper().logon(username, password)
+
+    def download_statement(self, account_id, date_from, date_to):
+        return self.get_scraper().download_statement(account_id, date_from, date_to)
+
+    def download_statement_file(self, account_id, date_from, date_to):
+        return self.download_statement(account_id, date_from, date_to).result()
+
+    def download_statements(self, accounts, date_from, date_to):
+        return self.get_scraper().download_statements(accounts, date_from, date_to)
+
+    def hold(self):
+        # taken by each run of downloads, the scraper is only closed once the last run still using it is finished
+        with self._lock:
+            self._holds += 1
+
+    def release_hold(self, timeout=0):
+        with self._lock:
+            self._holds -= 1
+            if self._holds > 0:
+                return
+        self.close(timeout)
+
+    def close(self, timeout=0, keep_spare=True):
+        if not keep_spare:
+            self._close_warming()
+        if not self.scraper:
+            return
+        if keep_spare and self.config.chrome_spare_idle_timeout_s:
+            self.scraper.release(timeout)
+            with self._lock:
+                self._cancel_spare_timer()
+                self._spare_timer = threading.Timer(self.config.chrome_spare_idle_timeout_s, self._close_idle_spare)
+                self._spare_timer.daemon = True
+                self._spare_timer.start()
+        else:
+            with self._lock:
+                self._cancel_spare_timer()
+            self.scraper.quit(timeout)
+            self.scraper = None
+
+    def _close_warming(self):
+        # chrome warmed up but never picked up, the app was only used for sheets or closed before it was ready
+        with self._lock:
+            warming, self._warming = self._warming, None
+        self._starter.shutdown(wait=False)
+        if warming is None:
+            return
+        try:
+            scraper = warming.result()
+        except Exception:
+            return
+        logging.info("Closing unused warmed up driver")
+        scraper.quit(0)
+
+    def _close_idle_spare(self):
+        with self._lock:
+            if not self._spare_timer:   # picked up again in the meantime
+                return
+            scraper, self.scraper = self.scraper, None
+            self._spare_timer = None
+        if scraper:
+            logging.info("Closing idle spare driver")
+            scraper.quit(0)
+
+    def _cancel_spare_timer(self):
+        if self._spare_timer:
+            self._spare_timer.cancel()
+            self._spare_timer = None
+
+
+def login(scheduler: JobScheduler, scraper: ChaseScraperWrapper, username, password):
+    return scheduler.submit(LANE_BROWSER, scraper.logon, username, password, name="chase logon")
+
+
+def get_statements(scheduler: JobScheduler, scraper: ChaseScraperWrapper, accounts, date_from, date_to, depends_on=(),
+                   close=True, journal: JobJournal = None):
+    from chase_scraper import DATE_FORMAT as CHASE_DATE_FORMAT
+    period_from = dt.datetime.strptime(date_from, FORMAT_DATE)
+    period_to = dt.datetime.strptime(date_to, FORMAT_DATE)
+    downloads = [scheduler.submit(LANE_BROWSER, download_statement_file, scraper, account, f"{period_from:{CHASE_DATE_FORMAT}}",
+                                  f"{period_to:{CHASE_DATE_FORMAT}}", journal, period_from, period_to,
+                                  depends_on=depends_on, name=f"download {account}")
+                 for account in accounts]
+    if close:
+        # the hold must be released even when the downloads get cancelled, or the drivers would never be closed
+        scraper.hold()
+        scheduler.submit(LANE_BROWSER, scraper.release_hold, DOWNLOAD_TIMEOUT_S, depends_on=downloads or depends_on,
+                         require_success=False, cancellable=False, name="chase close")
+    return downloads
+
+
+def download_statement_file(scraper: ChaseScraperWrapper, account, date_from, date_to, journal: JobJournal = None,
+                            period_from: dt.datetime = None, period_to: dt.datetime = None):
+    if journal is None:
+        return name_after_period(scraper.download_statement_file(account, date_from, date_to), account, period_from, period_to)
+    with journal.running(STAGE_DOWNLOAD, account, period_key(period_from, period_to)) as step:
+        path = name_after_period(scraper.download_statement_file(account, date_from, date_to), account, period_from, period_to)
+        step.digest = file_digest(path)
+        step.output = {"path": path}
+    return path
+
+
+def name_after_period(path, account, date_from: dt.datetime, date_to: dt.datetime):
+    # checking downloads do not carry their range, they get renamed after the period they were downloaded for so that
+    # the statement of every period has its own file, found again by the index and when resuming
+    if date_from is None:
+        return path
+    directory, name = os.path.split(path)
+    statement_file = parse_statement_filename(directory, name)
+    if statement_file is not None and statement_file.has_range:
+        return path
+    from chase_exporter import statement_filename
+    from download_watcher import move_without_overwrite
+    download_date = statement_file.download_date if statement_file is not None else dt.datetime.now()
+    return move_without_overwrite(path, directory, statement_filename(account, date_from, date_to, download_date))
+
+
+def downloaded_paths(downloads, resumed=None):
+    # statement returned by the download job of each account, keyed by str(account). None when the download did not
+    # succeed. resumed holds the statements a previous run downloaded, other accounts are looked up in the statements
+    # directory
+    paths = dict(resumed or {})
+    paths.update({account: job.result() if job.succeeded() else None for account, job in downloads.items() if job is not None})
+    return paths
+
+
+def pending_downloads(journal: JobJournal, accounts, date_from, date_to):
+    # accounts whose statement still has to be downloaded, and the statements of the others by str(account).
+    # A statement downloaded before the end of its period misses the transactions posted since, and the file named
+    # after the period must still be there with the content it was downloaded with
+    if journal is None:
+        return list(accounts), {}
+    period_from = dt.datetime.strptime(date_from, FORMAT_DATE)
+    period_to = dt.datetime.strptime(date_to, FORMAT_DATE)
+    period = period_key(period_from, period_to)
+    pending = []
+    resumed = {}
+    for account in accounts:
+        step = journal.finished(STAGE_DOWNLOAD, account, period, completed_after=period_to + dt.timedelta(days=1))
+        path = (step.output or {}).get("path") if step else None
+        statement_file = parse_statement_filename(*os.path.split(path)) if path else None
+        if statement_file is not None and (statement_file.date_from, statement_file.date_to) == (period_from, period_to) \
+                and file_digest(path) == step.digest:
+            journal.skip(step)
+            resumed[str(account)] = path
+        else:
+            pending.append(account)
+    return pending, resumed
+
+
+def upload_dataframe(sheet_uploader, df, date_from: dt.datetime, date_to: dt.datetime, update=False,
+                     journal: JobJournal = None, resume=False):
+    # when resuming, the same transactions are not uploaded twice for a period as long as their tab is still there
+    if journal is None:
+        return sheet_uploader.upload_dataframe(df, date_from, update)
+    period = period_key(date_from, date_to)
+    digest = dataframe_digest(df)
+    step = journal.finished(STAGE_UPLOAD, ALL_ACCOUNTS, period, digest) if resume else None
+    sheet = sheet_uploader.api.worksheet(step.output["sheet"]) if step is not None else None
+    if sheet is not None:
+        journal.skip(step)
+        return sheet
+    with journal.running(STAGE_UPLOAD, ALL_ACCOUNTS, period, digest) as running:
+        sheet = sheet_uploader.upload_dataframe(df, date_from, update)
+        running.output = {"sheet": sheet.title}
+    return sheet
+
+
+def push_expenses(pusher, tab, expenses, journal: JobJournal = None, resume=False, progress=None, cancelled=None):
+    # expenses of a tab are pushed once per content, a push that left expenses behind is run again
+    expenses = list(expenses)
+    if journal is None:
+        return pusher.push(expenses, progress, cancelled)
+    digest = content_digest([(desc, round(cost, 2), f"{date:{FORMAT_DATE}}") for desc, cost, date in expenses])
+    step = journal.finished(STAGE_SPLITWISE, ALL_ACCOUNTS, tab, digest) if resume else None
+    if step is not None:
+        journal.skip(step)
+        return {"created": 0, "skipped": len(expenses), "failed": 0, "cancelled": 0}
+    try:
+        summary = pusher.push(expenses, progress, cancelled)
+    except Exception as e:
+        journal.record(STAGE_SPLITWISE, ALL_ACCOUNTS, tab, STATUS_FAILED, digest, error=str(e))
+        raise
+    left = summary["failed"] + summary["cancelled"]
+    journal.record(STAGE_SPLITWISE, ALL_ACCOUNTS, tab, STATUS_FAILED if left else STATUS_DONE, digest, summary,
+                   f"{left} expense(s) not created" if left else None)
+    return summary
+
+
+def connect_sheets(config: cfg.Configuration):
+    from sheet_uploader import SheetUploader
+    sheet_uploader = SheetUploader(config)
+    sheet_uploader.connect()
+    return sheet_uploader
+
+
+def connect_splitwise(config: cfg.Configuration):
+    import splitwise_uploader as splitwise
+    return splitwise.connect_group_pusher(config)
@@ -0,0 +1,173 @@
+import time
+import random
+import socket
+import logging
+import threading
+import collections
+
+import configuration as cfg
+
+SERVICE_SHEETS = "sheets"
+SERVICE_SPLITWISE = "splitwise"
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    # rate tokens per second up to capacity, acquire() blocks until one is available and returns the time waited
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        waited = 0.
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def http_status(error):
+    # googleapiclient HttpError carries the response in resp, splitwise exceptions keep the status in a 1-tuple
+    resp = getattr(error, 'resp', None)
+    if resp is not None and getattr(resp, 'status', None) is not None:
+        return int(resp.status)
+    status = getattr(error, 'http_status', None)
+    if isinstance(status, tuple):
+        status = status[0] if status else None
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return int(status) if status is not None else None
+
+
+def retry_after(error):
+    headers = getattr(error, 'http_headers', None) or getattr(error, 'resp', None) or {}
+    try:
+        value = headers.get('retry-after') or headers.get('Retry-After')
+        return float(value) if value is not None else None
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    status = http_status(error)
+    if status is not None:
+        return status in RETRY_STATUSES
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout)) or \
+        type(error).__name__ in ("ConnectionError", "Timeout", "ReadTimeout", "ConnectTimeout")
+
+
+class RateLimiter:
+    # every call to a service goes through its limiter: a token bucket keeps the request rate under the quota,
+    # identical read calls in flight at the same time share a single request, throttling (429) and server errors
+    # are retried with exponential backoff and jitter. Calls that are not idempotent are only retried when throttled,
+    # a server error does not tell whether the request went through
+    def __init__(self, service, requests_per_minute, burst=None, max_retries=5, base_delay_s=1., max_delay_s=64.):
+        self.service = service
+        self.bucket = TokenBucket(requests_per_minute / 60., burst or max(1, requests_per_minute // 10))
+        self.max_retries = max_retries
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.counters = collections.Counter()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def call(self, fn, *args, coalesce_key=None, idempotent=True, **kwargs):
+        if coalesce_key is None:
+            return self._call(fn, args, kwargs, idempotent)
+        with self._lock:
+            shared = self._in_flight.get(coalesce_key)
+            if shared is None:
+                shared = self._in_flight[coalesce_key] = _SharedCall()
+                owner = True
+            else:
+                self.counters["coalesced"] += 1
+                owner = False
+        if not owner:
+            return shared.wait()
+        try:
+            shared.set_result(self._call(fn, args, kwargs, idempotent))
+        except BaseException as e:
+            shared.set_error(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[coalesce_key]
+        return shared.result
+
+    def _call(self, fn, args, kwargs, idempotent):
+        attempt = 0
+        while True:
+            waited = self.bucket.acquire()
+            with self._lock:
+                self.counters["calls"] += 1
+                self.counters["throttled_ms"] += int(waited * 1000)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                retryable = is_retryable(e) if idempotent else http_status(e) == 429
+                if attempt >= self.max_retries or not retryable:
+                    with self._lock:
+                        self.counters["errors"] += 1
+                    raise
+                # full jitter, unless the service says how long to wait, never more than max_delay_s
+                delay = min(self.max_delay_s, retry_after(e) or random.uniform(0, self.base_delay_s * 2 ** attempt))
+                attempt += 1
+                with self._lock:
+                    self.counters["retries"] += 1
+                    self.counters[f"retried_{http_status(e) or 'network'}"] += 1
+                logging.warning(f"{self.service} call failed ({e}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+class _SharedCall:
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def set_result(self, result):
+        self.result = result
+        self._done.set()
+
+    def set_error(self, error):
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(config: cfg.Configuration, service):
+    # one limiter per service for the whole process, quotas are per user and not per client
+    with _limiters_lock:
+        if service not in _limiters:
+            _limiters[service] = RateLimiter(service, getattr(config, f"{service}_requests_per_minute"),
+                                             max_retries=config.api_max_retries)
+        return _limiters[service]
+
+
+def rate_limiter_stats():
+    with _limiters_lock:
+        return {service: limiter.stats() for service, limiter in _limiters.items()}
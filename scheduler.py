@@ -0,0 +1,192 @@
+import time
+import queue
+import logging
+import threading
+from enum import Enum
+
+LANE_BROWSER = "browser"
+LANE_PARSE = "parse"
+LANE_SHEETS = "sheets"
+LANE_SPLITWISE = "splitwise"
+
+DEFAULT_LANES = {LANE_BROWSER: 1, LANE_PARSE: 1, LANE_SHEETS: 1, LANE_SPLITWISE: 1}
+
+# require_success value running a job once all its dependencies are finished if at least one of them succeeded
+REQUIRE_ANY = "any"
+
+
+class JobStatus(Enum):
+    Waiting = 1
+    Queued = 2
+    Running = 3
+    Done = 4
+    Failed = 5
+    Cancelled = 6
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, name, lane, action, args, kwargs, cancellable=True):
+        self.name = name
+        self.lane = lane
+        self.action = action
+        self.args = args
+        self.kwargs = kwargs
+        # jobs releasing resources still run when the batch they belong to gets cancelled
+        self.cancellable = cancellable
+        self.status = JobStatus.Waiting
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._result = None
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._callbacks = []
+
+    @property
+    def duration(self):
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+    def done(self):
+        return self._finished.is_set()
+
+    def succeeded(self):
+        return self.status == JobStatus.Done
+
+    def result(self, timeout=None):
+        if not self._finished.wait(timeout):
+            raise TimeoutError(f"Job {self.name} still {self.status.name} after {timeout}s")
+        if self.error:
+            raise self.error
+        return self._result
+
+    def cancel(self, reason=None):
+        with self._lock:
+            if not self.cancellable or self.status not in (JobStatus.Waiting, JobStatus.Queued):
+                return False
+            self.status = JobStatus.Cancelled
+        self._finish(JobStatus.Cancelled, error=JobCancelled(reason or f"Job {self.name} cancelled"))
+        return True
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _start(self):
+        with self._lock:
+            if self.status != JobStatus.Queued:
+                return False
+            self.status = JobStatus.Running
+            self.started_at = time.time()
+            return True
+
+    def _finish(self, status, result=None, error=None):
+        with self._lock:
+            if self._finished.is_set():
+                return
+            self.status = status
+            self._result = result
+            self.error = error
+            self.finished_at = time.time()
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logging.error(f"Callback of job {self.name} failed: {e}")
+
+    def __repr__(self):
+        duration = f" in {self.duration:.2f}s" if self.duration is not None else ""
+        return f"Job({self.name} [{self.lane}] {self.status.name}{duration})"
+
+
+class JobScheduler:
+    # runs jobs on named lanes, each lane having its own worker threads blocking on a queue.
+    # A job only gets queued once the jobs it depends on are finished
+    def __init__(self, lanes=None):
+        self._lanes = {lane: max(1, nb_workers) for lane, nb_workers in (lanes or DEFAULT_LANES).items()}
+        self._queues = {}
+        self._threads = []
+        for lane, nb_workers in self._lanes.items():
+            self._queues[lane] = queue.Queue()
+            for i in range(nb_workers):
+                thread = threading.Thread(target=self._work, args=(lane,), name=f"{lane}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, lane, action, *args, depends_on=(), require_success=True, name=None, cancellable=True, **kwargs):
+        if lane not in self._queues:
+            raise ValueError(f"Unknown lane '{lane}'")
+        job = Job(name or getattr(action, '__name__', str(action)), lane, action, args, kwargs, cancellable)
+        if not cancellable:
+            # runs once its dependencies are finished, whatever their outcome
+            require_success = False
+        dependencies = [d for d in depends_on if d is not None]
+        if not dependencies:
+            self._enqueue(job)
+            return job
+
+        remaining = [len(dependencies)]
+        succeeded = [0]
+        lock = threading.Lock()
+
+        def on_dependency_done(dependency):
+            if require_success is True and not dependency.succeeded():
+                job.cancel(f"Job {job.name} cancelled: dependency {dependency.name} {dependency.status.name.lower()}")
+                return
+            with lock:
+                remaining[0] -= 1
+                succeeded[0] += dependency.succeeded()
+                ready = remaining[0] == 0
+            if not ready:
+                return
+            if require_success == REQUIRE_ANY and not succeeded[0]:
+                job.cancel(f"Job {job.name} cancelled: none of its dependencies succeeded")
+            else:
+                self._enqueue(job)
+
+        for dependency in dependencies:
+            dependency.add_done_callback(on_dependency_done)
+        return job
+
+    def shutdown(self, wait=False):
+        for lane, q in self._queues.items():
+            for _ in range(self._lanes[lane]):
+                q.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _enqueue(self, job):
+        with job._lock:
+            if job.status != JobStatus.Waiting:
+                return
+            job.status = JobStatus.Queued
+        self._queues[job.lane].put(job)
+
+    def _work(self, lane):
+        q = self._queues[lane]
+        while True:
+            job = q.get()
+            if job is None:
+                return
+            if not job._start():
+                continue
+            try:
+                result = job.action(*job.args, **job.kwargs)
+            except Exception as e:
+                logging.error(f"Job {job.name} failed after {job.duration:.2f}s: {e}")
+                job._finish(JobStatus.Failed, error=e)
+            else:
+                logging.info(f"Job {job.name} done in {job.duration:.2f}s")
+                job._finish(JobStatus.Done, result=result)
@@ -0,0 +1,64 @@
+import os
+import json
+import logging
+from cryptography.fernet import Fernet, InvalidToken
+
+# outside of the session directory, next to the profile it would not protect anything
+DEFAULT_KEY_PATH = "~/.config/chazeets/session.key"
+COOKIES_FILENAME = "cookies.bin"
+PROFILE_DIRNAME = "profile"
+
+
+class SessionStore:
+    # keeps the Chrome profile and the authenticated cookies of the last session on disk,
+    # cookies are encrypted with a key kept outside of the session directory
+    def __init__(self, directory, key_path=DEFAULT_KEY_PATH):
+        self.directory = os.path.abspath(directory)
+        self.profile_dir = os.path.join(self.directory, PROFILE_DIRNAME)
+        self.key_path = os.path.abspath(os.path.expanduser(key_path))
+        if os.path.commonpath([self.key_path, self.directory]) == self.directory:
+            raise ValueError(f"The session key {self.key_path} must not be stored in the session directory {self.directory}")
+        os.makedirs(self.profile_dir, mode=0o700, exist_ok=True)
+        self._fernet = Fernet(self._load_or_create_key())
+
+    def _load_or_create_key(self):
+        path = self.key_path
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        key = Fernet.generate_key()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+        return key
+
+    def save_cookies(self, cookies):
+        path = os.path.join(self.directory, COOKIES_FILENAME)
+        token = self._fernet.encrypt(json.dumps(cookies).encode('utf-8'))
+        fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(token)
+        os.replace(path + ".tmp", path)
+
+    def load_cookies(self):
+        path = os.path.join(self.directory, COOKIES_FILENAME)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return json.loads(self._fernet.decrypt(f.read()).decode('utf-8'))
+        except (InvalidToken, ValueError) as e:
+            logging.warning(f"Ignoring unreadable saved session {path}: {e}")
+            return None
+
+    def clear(self):
+        path = os.path.join(self.directory, COOKIES_FILENAME)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_session_store(config):
+    if not config.chase_session_dir:
+        return None
+    return SessionStore(config.chase_session_dir, config.chase_session_key_path or DEFAULT_KEY_PATH)
@@ -1,11 +1,26 @@
 import os
 import abc
+import time
+import bisect
+import random
+import threading
+import collections
 import datetime as dt
+import numpy as np
 import pandas as pd
 import pygsheets
+from pygsheets.custom_types import ValueRenderOption, DateTimeRenderOption
 import logging
 import configuration as cfg
+import categoriser
+# the frame columns are shared with the categorisation rules, which must not depend on this module
+from categoriser import (DF_COL_ACCOUNT, DF_COL_DATE, DF_COL_ITEM, DF_COL_CATEGORY, DF_COL_PRICE, DF_COL_FACTOR,
+                         DF_COL_PRICE_TO_SHARE, DF_COLUMNS, with_price_to_share)
 from configuration import AccountType
+from statement_cache import get_statement_cache
+from statement_index import StatementIndex, parse_statement_filename
+from transaction_store import get_transaction_store, transaction_fingerprints
+from rate_limiter import get_rate_limiter, SERVICE_SHEETS
 
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
@@ -13,113 +28,429 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SHEET_TEMPLATE_NAME = "_TEMPLATE_"
 SHEET_CATEGORY_COL = 9
 SHEET_CATEGORY_ROW = 4
+WORKSHEETS_CACHE_TTL_S = 300
+# reads that can be shared between callers asking for the same thing at the same time
+COALESCED_CALLS = {"open_by_key", "values_get"}
+# rows sent per batchUpdate, past that the upload is split over several calls and rolled back on failure
+UPLOAD_BATCH_ROWS = 10000
+SHEETS_EPOCH = dt.datetime(1899, 12, 30)
 
-# Date	Item	category	price		share factor	price to share
-DF_COL_ACCOUNT = "Account"
-DF_COL_DATE = "Date"
-DF_COL_ITEM = "Item"
-DF_COL_CATEGORY = "Category"
-DF_COL_PRICE = "Price"
-DF_COL_FACTOR = "Share Factor"
-DF_COL_PRICE_TO_SHARE = "Price to share"
+# written once in the first data row, the sheet fills the whole column from it.
+# Per row INDIRECT formulas are volatile and made every edit recalculate the whole tab
+PRICE_TO_SHARE_FORMULA = '=ARRAYFORMULA(IF(E2:E="",,E2:E*F2:F))'
+STATEMENT_DATE_FORMAT = '%m/%d/%Y'
+# bump when the statement -> dataframe transforms change, invalidates cached frames
+STATEMENT_PARSER_VERSION = 2
 
 
 class SheetManager:
-    def __init__(self, sheet_id, credentials_json, scopes):
+    def __init__(self, sheet_id, credentials_json, scopes, cache_ttl_s=WORKSHEETS_CACHE_TTL_S, limiter=None):
         self.client = pygsheets.authorize(client_secret=credentials_json, scopes=scopes)
-        self.sheet = self.client.open_by_key(sheet_id)
+        self.limiter = limiter
+        if limiter:
+            # pygsheets sleeps 100s on the first 429 and googleapiclient retries on its own, the limiter backs off
+            # instead so that retries are counted once and paced by the bucket
+            self.client.sheet.check = False
+            self.client.sheet.retries = 0
+        self.cache_ttl_s = cache_ttl_s
+        self.api_calls = collections.Counter()
+        # bumped on every write made through the manager, refresh() starts a new generation
+        self._generation = 0
+        self._revisions = collections.Counter()
+        self._lock = threading.RLock()
+        self.sheet = self._call("open_by_key", self.client.open_by_key, sheet_id)
+        self._index_worksheets()
+
+    def _call(self, name, fn, *args, **kwargs):
+        self.api_calls[name] += 1
+        if self.limiter is None:
+            return fn(*args, **kwargs)
+        key = (name, args, tuple(sorted(kwargs.items()))) if name in COALESCED_CALLS else None
+        return self.limiter.call(fn, *args, coalesce_key=key, **kwargs)
 
     def refresh(self):
-        self.sheet = self.client.open_by_key(self.sheet.id)
+        with self._lock:
+            self.sheet = self._call("open_by_key", self.client.open_by_key, self.sheet.id)
+            self._index_worksheets()
+            self._generation += 1
+
+    def revision(self, title):
+        with self._lock:
+            return self._generation, self._revisions[title]
+
+    def _index_worksheets(self):
+        # title -> worksheet, titles in tab order and sorted titles for prefix lookups
+        worksheets = sorted(self.sheet.worksheets(), key=lambda s: s.index)
+        self._by_title = {s.title: s for s in worksheets}
+        self._tab_order = [s.title for s in worksheets]
+        self._sorted_titles = sorted(self._by_title)
+        self._fetched_at = time.time()
+
+    def _worksheets(self):
+        with self._lock:
+            if time.time() - self._fetched_at > self.cache_ttl_s:
+                self.refresh()
+            return self._by_title
+
+    def _add_to_index(self, ws, index=None):
+        with self._lock:
+            self._by_title[ws.title] = ws
+            if index is None:
+                self._tab_order.append(ws.title)
+            else:
+                self._tab_order.insert(index, ws.title)
+            bisect.insort(self._sorted_titles, ws.title)
+        return ws
+
+    def worksheet(self, title):
+        return self._worksheets().get(title)
+
+    def worksheet_titles(self):
+        with self._lock:
+            self._worksheets()
+            return list(self._tab_order)
 
     def get_safe_new_sheet_name(self, wanted_name):
-        curr_sheets = {s.title: s for s in self.sheet.worksheets()}
+        curr_sheets = self._worksheets()
         safe_name = wanted_name
         while safe_name in curr_sheets:
             safe_name = f"{wanted_name}_{dt.datetime.now():%Y%m%d_%H%M%S}"
         return safe_name
 
-    def safe_create_sheet(self, name):
-        safe_name = self.get_safe_new_sheet_name(name)
-        return self.sheet.add_worksheet(safe_name)
+    def safe_create_sheet(self, name, index=None):
+        with self._lock:
+            safe_name = self.get_safe_new_sheet_name(name)
+            return self._add_to_index(self._call("add_worksheet", self.sheet.add_worksheet, safe_name, index=index), index)
+
+    def safe_duplicate_sheet(self, target_name, source_name, index=None):
+        with self._lock:
+            source_sheet = self.worksheet(source_name)
+            if source_sheet is None:
+                raise ValueError(f"Can't duplicate sheet {source_name}: does not exist")
+            safe_name = self.get_safe_new_sheet_name(target_name)
+            return self._add_to_index(self._call("add_worksheet", self.sheet.add_worksheet, safe_name,
+                                                 src_worksheet=source_sheet, index=index), index)
+
+    def duplicate_sheet_with_values(self, target_name, source_name, rows, index=0, date_columns=()):
+        # duplicates, moves and fills the new tab in a single batchUpdate, which the API applies atomically.
+        # Uploads over UPLOAD_BATCH_ROWS take more calls, the new tab is then deleted if any of them fails
+        with self._lock:
+            source_sheet = self.worksheet(source_name)
+            if source_sheet is None:
+                raise ValueError(f"Can't duplicate sheet {source_name}: does not exist")
+            safe_name = self.get_safe_new_sheet_name(target_name)
+            sheet_id = self._new_sheet_id()
+            requests = [{"duplicateSheet": {"sourceSheetId": source_sheet.id, "insertSheetIndex": index,
+                                            "newSheetId": sheet_id, "newSheetName": safe_name}}]
+            if len(rows) > source_sheet.rows:
+                requests.append({"appendDimension": {"sheetId": sheet_id, "dimension": "ROWS",
+                                                     "length": len(rows) - source_sheet.rows}})
+            batches = [rows[i:i + UPLOAD_BATCH_ROWS] for i in range(0, len(rows), UPLOAD_BATCH_ROWS)] or [[]]
+            requests += self._update_cells_requests(sheet_id, 0, 0, batches[0], date_columns)
+            reply = self._call("batch_update", self.client.sheet.batch_update, self.sheet.id, requests)
+            ws = self.sheet.worksheet_cls(self.sheet, {"properties": reply["replies"][0]["duplicateSheet"]["properties"]})
+            try:
+                for i, batch in enumerate(batches[1:], start=1):
+                    self._call("batch_update", self.client.sheet.batch_update, self.sheet.id,
+                               self._update_cells_requests(sheet_id, i * UPLOAD_BATCH_ROWS, 0, batch, date_columns))
+            except Exception:
+                logging.error(f"Upload to {safe_name} failed, deleting the partially filled tab")
+                try:
+                    self._call("batch_update", self.client.sheet.batch_update, self.sheet.id, [{"deleteSheet": {"sheetId": sheet_id}}])
+                except Exception as e:
+                    logging.error(f"Could not delete partially filled tab {safe_name}: {e}")
+                raise
+            self._revisions[safe_name] += 1
+            return self._add_to_index(ws, index)
+
+    def _new_sheet_id(self):
+        used = {s.id for s in self._worksheets().values()}
+        sheet_id = random.randint(1, 2 ** 31 - 1)
+        while sheet_id in used:
+            sheet_id = random.randint(1, 2 ** 31 - 1)
+        return sheet_id
+
+    def get_values(self, ws, cell_range):
+        # raw numbers, dates as serial days whatever the date format of the sheet
+        reply = self._call("values_get", self.client.sheet.values_get, self.sheet.id, f"'{ws.title}'!{cell_range}",
+                           value_render_option=ValueRenderOption.UNFORMATTED_VALUE,
+                           date_time_render_option=DateTimeRenderOption.SERIAL_NUMBER)
+        return reply.get('values', [])
+
+    def update_cells(self, ws, blocks, nb_rows=0, date_columns=(), column_formulas=()):
+        # blocks of (first row, first column, rows of values) written in a single batchUpdate.
+        # column_formulas are (row, column, formula) array formulas, the cells below them get cleared
+        requests = []
+        if nb_rows > ws.rows:
+            requests.append({"appendDimension": {"sheetId": ws.id, "dimension": "ROWS", "length": nb_rows - ws.rows}})
+        for first_row, first_col, rows in blocks:
+            requests += self._update_cells_requests(ws.id, first_row, first_col, rows, date_columns)
+        for row, col, formula in column_formulas:
+            requests.append({"repeatCell": {
+                "range": {"sheetId": ws.id, "startRowIndex": row + 1, "startColumnIndex": col, "endColumnIndex": col + 1},
+                "cell": {},
+                "fields": "userEnteredValue",
+            }})
+            requests += self._update_cells_requests(ws.id, row, col, [[formula]], ())
+        if requests:
+            self._call("batch_update", self.client.sheet.batch_update, self.sheet.id, requests)
+            with self._lock:
+                self._revisions[ws.title] += 1
 
-    def safe_duplicate_sheet(self, target_name, source_name):
-        if not self.sheet_exists(source_name):
-            raise ValueError(f"Can't duplicate sheet {source_name}: does not exist")
-        safe_name = self.get_safe_new_sheet_name(target_name)
-        source_sheet = self.sheet.worksheet_by_title(source_name)
-        return self.sheet.add_worksheet(safe_name, src_worksheet=source_sheet)
+    @staticmethod
+    def _update_cells_requests(sheet_id, first_row, first_col, rows, date_columns):
+        if not rows:
+            return []
+        return [{"updateCells": {
+            "start": {"sheetId": sheet_id, "rowIndex": first_row, "columnIndex": first_col},
+            "rows": [{"values": [_cell(v, c in date_columns) for c, v in enumerate(row, start=first_col)]} for row in rows],
+            "fields": "userEnteredValue,userEnteredFormat.numberFormat",
+        }}]
 
     def sheet_exists(self, name):
-        curr_sheets = {s.title: s for s in self.sheet.worksheets()}
-        return name in curr_sheets
+        return name in self._worksheets()
 
     def find_sheet_by_prefix(self, prefix):
-        for s in self.sheet.worksheets():
-            if s.title.startswith(prefix):
-                return s
-        return None
+        with self._lock:
+            by_title = self._worksheets()
+            # titles starting with the prefix follow each other in the sorted titles
+            start = end = bisect.bisect_left(self._sorted_titles, prefix)
+            while end < len(self._sorted_titles) and self._sorted_titles[end].startswith(prefix):
+                end += 1
+            if start == end:
+                return None
+            # copies of a tab get a timestamp suffix and are inserted in front, the first in tab order is the newest
+            return by_title[min(self._sorted_titles[start:end], key=self._tab_order.index)]
 
     def get_or_create_worksheet(self, name):
-        curr_sheets = {s.title: s for s in self.sheet.worksheets()}
-        ws = self.sheet.add_worksheet(name) if name not in curr_sheets else curr_sheets[name]
-        return ws
+        with self._lock:
+            ws = self.worksheet(name)
+            return ws if ws is not None else self._add_to_index(self._call("add_worksheet", self.sheet.add_worksheet, name))
+
+
+def _cell(value, is_date=False):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return {}
+    if is_date and not isinstance(value, str):
+        serial = (pd.Timestamp(value) - SHEETS_EPOCH).days
+        return {"userEnteredValue": {"numberValue": serial},
+                "userEnteredFormat": {"numberFormat": {"type": "DATE", "pattern": "mm/dd/yyyy"}}}
+    if isinstance(value, str):
+        if value.startswith('='):
+            return {"userEnteredValue": {"formulaValue": value}}
+        return {"userEnteredValue": {"stringValue": value}}
+    if isinstance(value, (bool, np.bool_)):
+        return {"userEnteredValue": {"boolValue": bool(value)}}
+    return {"userEnteredValue": {"numberValue": float(value)}}
+
+
+def sheet_dates(values):
+    # serial days read back from the sheet, dates typed in as text are parsed in the statement format
+    values = pd.Series(values, dtype='object')
+    serials = pd.to_numeric(values.where(values.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool))), errors='coerce')
+    dates = SHEETS_EPOCH + pd.to_timedelta(serials.round(), unit='D')
+    return dates.fillna(pd.to_datetime(values.where(serials.isna()), format=STATEMENT_DATE_FORMAT, errors='coerce'))
+
+
+def parse_statement_dates(series):
+    # statements only hold a few distinct dates, parsing each of them once is much cheaper than every row
+    codes, uniques = pd.factorize(series)
+    parsed = pd.DatetimeIndex(pd.to_datetime(pd.Index(uniques).astype('str'), format=STATEMENT_DATE_FORMAT))
+    return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=series.index)
 
 
 class Statement:
     data: pd.DataFrame
 
-    def __init__(self, account: cfg.Account, path: str):
+    def __init__(self, account: cfg.Account, path: str, date_from: dt.datetime = None, date_to: dt.datetime = None):
         self.account = account
         self.path = path
+        # only set when the file spans more than the wanted period, rows outside of it get dropped
+        self.date_from = date_from
+        self.date_to = date_to
+        self.data = None
+
+    # columns read from the csv and their types, dates are read as categories and parsed once per distinct value
+    CSV_DTYPES = {}
 
     def load(self):
         if os.path.exists(self.path):
-            self.data = pd.read_csv(filepath_or_buffer=self.path, index_col=False)
+            self.data = self._read_csv()
         else:
             logging.warning(f"could not find statement file for account {self.account}. File {self.path} does not exist")
 
-    @abc.abstractmethod
+    def iter_chunks(self, chunk_size):
+        # normalised frames of at most chunk_size rows, memory stays bounded whatever the size of the file
+        if not os.path.exists(self.path):
+            logging.warning(f"could not find statement file for account {self.account}. File {self.path} does not exist")
+            return
+        with self._read_csv(chunksize=chunk_size) as reader:
+            for chunk in reader:
+                yield self._normalise(chunk)
+
+    def _read_csv(self, **kwargs):
+        return pd.read_csv(filepath_or_buffer=self.path, index_col=False, usecols=list(self.CSV_DTYPES),
+                           dtype=self.CSV_DTYPES, **kwargs)
+
     def get_as_dataframe(self):
+        if self.data is None:
+            return None
+        return self._normalise(self.data)
+
+    @abc.abstractmethod
+    def _normalise(self, data):
         return None
 
-    def _create_empty_dataframe(self, date_series, item_series, category_series, price_series):
-        df = pd.DataFrame(columns=[DF_COL_DATE, DF_COL_ITEM, DF_COL_CATEGORY, DF_COL_PRICE])
-        nb_rows = len(date_series)
-        df[DF_COL_ACCOUNT] = pd.Series([str(self.account)] * nb_rows)
-        df[DF_COL_DATE] = date_series
-        df[DF_COL_ITEM] = item_series
-        df[DF_COL_CATEGORY] = category_series
-        df[DF_COL_PRICE] = price_series
-        df[DF_COL_FACTOR] = pd.Series([0] * nb_rows)
-        df[DF_COL_PRICE_TO_SHARE] = pd.Series(['=INDIRECT("R[0]C[-2]", FALSE) * INDIRECT("R[0]C[-1]",FALSE)'] * nb_rows)
-        return df
+    def clip(self, df):
+        if df is None or self.date_from is None:
+            return df
+        return df[(df[DF_COL_DATE] >= self.date_from) & (df[DF_COL_DATE] <= self.date_to)]
+
+    def cache_variant(self):
+        return f"{type(self).__name__}|{self.account}|{STATEMENT_PARSER_VERSION}"
+
+    def _create_dataframe(self, date_series, item_series, category_series, price_series):
+        # scalars are broadcast by pandas along the index of the series
+        df = pd.DataFrame({
+            DF_COL_ACCOUNT: str(self.account),
+            DF_COL_DATE: parse_statement_dates(date_series),
+            DF_COL_ITEM: item_series,
+            DF_COL_CATEGORY: category_series.astype('category'),
+            DF_COL_PRICE: price_series.astype('float64'),
+            DF_COL_FACTOR: 0.,
+        }, columns=DF_COLUMNS)
+        df[DF_COL_ACCOUNT] = df[DF_COL_ACCOUNT].astype('category')
+        return with_price_to_share(df)
 
 
 class CheckingStatement(Statement):
-    def get_as_dataframe(self):
-        if self.data is None:
-            return None
-        df = self._create_empty_dataframe(
-            self.data["Posting Date"],
-            self.data["Description"],
-            self.data["Type"].str.replace('_', ' ').str.lower(),
-            self.data["Amount"] * -1)
+    CSV_DTYPES = {"Posting Date": 'category', "Description": 'str', "Type": 'category', "Amount": 'float64'}
+
+    def _normalise(self, data):
+        df = self._create_dataframe(
+            data["Posting Date"],
+            data["Description"],
+            data["Type"].astype('str').str.replace('_', ' ').str.lower(),
+            data["Amount"] * -1)
         return df
 
 
 class CreditCardStatement(Statement):
-    def get_as_dataframe(self):
-        if self.data is None:
-            return None
-        df = self._create_empty_dataframe(
-            self.data["Transaction Date"],
-            self.data["Description"],
-            self.data["Category"],
-            self.data["Amount"] * -1)
+    CSV_DTYPES = {"Transaction Date": 'category', "Description": 'str', "Category": 'category', "Amount": 'float64'}
+
+    def _normalise(self, data):
+        df = self._create_dataframe(
+            data["Transaction Date"],
+            data["Description"],
+            data["Category"],
+            data["Amount"] * -1)
         return df
 
 
+def empty_statements_dataframe():
+    return pd.DataFrame({
+        DF_COL_ACCOUNT: pd.Categorical([]),
+        DF_COL_DATE: pd.Series([], dtype='datetime64[ns]'),
+        DF_COL_ITEM: pd.Series([], dtype='object'),
+        DF_COL_CATEGORY: pd.Categorical([]),
+        DF_COL_PRICE: pd.Series([], dtype='float64'),
+        DF_COL_FACTOR: pd.Series([], dtype='float64'),
+        DF_COL_PRICE_TO_SHARE: pd.Series([], dtype='float64'),
+    }, columns=DF_COLUMNS)
+
+
+def statement_to_dataframe(statement: Statement, cache=None, clip=True, chunk_size=None):
+    df = cache.get(statement.path, statement.cache_variant()) if cache else None
+    if df is None:
+        if chunk_size:
+            # the raw csv is only held chunk by chunk. Without cache rows outside of the period are dropped right away,
+            # the cache keeps the whole statement
+            keep = statement.clip if clip and not cache else (lambda chunk: chunk)
+            chunks = [keep(chunk) for chunk in statement.iter_chunks(chunk_size)]
+            df = concat_statement_frames(chunks) if chunks else None
+        else:
+            statement.load()
+            df = statement.get_as_dataframe()
+        if cache and df is not None:
+            cache.put(statement.path, statement.cache_variant(), df)
+    return statement.clip(df) if clip else df
+
+
+def statements_to_dataframe(statements, cache=None, chunk_size=None):
+    frames = []
+    for s in statements:
+        dff = statement_to_dataframe(s, cache, chunk_size=chunk_size)
+        if dff is not None:
+            frames.append(dff)
+    if not frames:
+        return empty_statements_dataframe()
+    return concat_statement_frames(frames)
+
+
+def concat_statement_frames(frames):
+    df = pd.concat(frames, ignore_index=True)
+    # categories differ between statements, concat falls back to object columns
+    for col in (DF_COL_ACCOUNT, DF_COL_CATEGORY):
+        df[col] = df[col].astype('category')
+    return df
+
+
+def transactions_to_dataframe(transactions):
+    return with_price_to_share(pd.DataFrame({
+        DF_COL_ACCOUNT: transactions["account"].astype('category'),
+        DF_COL_DATE: pd.to_datetime(transactions["date"], format='%Y-%m-%d'),
+        DF_COL_ITEM: transactions["item"],
+        DF_COL_CATEGORY: transactions["category"].astype('category'),
+        DF_COL_PRICE: transactions["price"].astype('float64'),
+        DF_COL_FACTOR: 0.,
+    }, columns=DF_COLUMNS, index=transactions.index))
+
+
+def compute_totals(df):
+    # same numbers as the category totals of the tab, computed from the frame without reading the sheet back
+    totals = df.groupby(DF_COL_CATEGORY, observed=True, sort=True)[DF_COL_PRICE_TO_SHARE].sum()
+    return [ExpenseTotal(str(category), round(float(total), 2)) for category, total in totals.items()]
+
+
+def to_store_dataframe(df):
+    return pd.DataFrame({
+        "account": df[DF_COL_ACCOUNT],
+        "date": df[DF_COL_DATE],
+        "item": df[DF_COL_ITEM],
+        "category": df[DF_COL_CATEGORY],
+        "price": df[DF_COL_PRICE],
+    })
+
+
+def sheet_row_keys(account, date, item):
+    # prices are left out so that a transaction whose amount changed is still matched to its row
+    return transaction_fingerprints(account, date, item, pd.Series(0., index=pd.Series(account).index))
+
+
+def _column_letter(index):
+    letters = ""
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def to_sheet_rows(df):
+    # plain python values in DF_COLUMNS order, dates stay timestamps and are typed as dates by the uploader.
+    # Price to share is left empty, the sheet computes it from PRICE_TO_SHARE_FORMULA so that share factors can be edited
+    sheet_df = df[DF_COLUMNS].copy()
+    for col in (DF_COL_ACCOUNT, DF_COL_CATEGORY):
+        sheet_df[col] = sheet_df[col].astype('object')
+    sheet_df[DF_COL_PRICE_TO_SHARE] = None
+    return sheet_df.astype('object').where(sheet_df.notna(), None).values.tolist()
+
+
+STATEMENT_TYPES = {
+    AccountType.Checking: CheckingStatement,
+    AccountType.CreditCard: CreditCardStatement,
+}
+
+
 class ExpenseTotal:
     def __init__(self, item, value):
         self.item = item
@@ -132,62 +463,173 @@ class ExpenseTotal:
 class SheetUploader:
     def __init__(self, config: cfg.Configuration):
         self.config = config
-        self.api = SheetManager(config.google_spreadsheet_id, config.google_credentials_path, SCOPES)
+        self._api = None
+        self._connect_lock = threading.Lock()
+        self.index = StatementIndex(config.statements_download_dir)
+        self.store = get_transaction_store(config)
+        # a file is only parsed once into the store, the statement cache only serves uploads made without it
+        self.cache = get_statement_cache(config) if self.store is None else None
+        self.rules = categoriser.get_rule_set(config)
+        self.last_upload_api_calls = 0
+        self._totals = {}
+
+    @property
+    def api(self):
+        # google is only authorized on first use, connect() does it ahead of time
+        with self._connect_lock:
+            if self._api is None:
+                self._api = SheetManager(self.config.google_spreadsheet_id, self.config.google_credentials_path, SCOPES,
+                                         limiter=get_rate_limiter(self.config, SERVICE_SHEETS))
+            return self._api
+
+    def connect(self):
+        return self.api
 
     @staticmethod
     def sheet_name(date):
         return f"{date:%b %Y}"
 
-    def upload_statements(self, date_from: dt.datetime, date_to: dt.datetime, today: dt.datetime):
-        df = pd.DataFrame(columns=[DF_COL_ACCOUNT, DF_COL_DATE, DF_COL_ITEM, DF_COL_CATEGORY, DF_COL_PRICE, DF_COL_FACTOR, DF_COL_PRICE_TO_SHARE])
-        for i, s in enumerate(self.enumerate_statements(today, date_from, date_to)):
-            s.load()
-            dff = s.get_as_dataframe()
-            if dff is not None:
-                df = df.append(dff)
-
-        sheet = self.api.safe_duplicate_sheet(SheetUploader.sheet_name(date_from), SHEET_TEMPLATE_NAME)
-        sheet.index = 0
-        sheet.set_dataframe(df, (1, 1))
-
-    def enumerate_statements(self, download_date, date_from, date_to):
+    def upload_statements(self, date_from: dt.datetime, date_to: dt.datetime, update=False):
+        return self.upload_dataframe(self.get_statements_dataframe(date_from, date_to), date_from, update)
+
+    def upload_dataframe(self, df, date_from: dt.datetime, update=False):
+        calls_before = sum(self.api.api_calls.values())
+        if update:
+            sheet = self.find_month_sheet(date_from)
+            if sheet is not None:
+                self.update_sheet(sheet, df)
+                self.last_upload_api_calls = sum(self.api.api_calls.values()) - calls_before
+                return sheet
+            logging.info(f"No tab for {SheetUploader.sheet_name(date_from)} yet, creating it")
+        rows = [list(df.columns)] + to_sheet_rows(df)
+        if len(rows) > 1:
+            rows[1][DF_COLUMNS.index(DF_COL_PRICE_TO_SHARE)] = PRICE_TO_SHARE_FORMULA
+        sheet = self.api.duplicate_sheet_with_values(SheetUploader.sheet_name(date_from), SHEET_TEMPLATE_NAME, rows,
+                                                     index=0, date_columns=(DF_COLUMNS.index(DF_COL_DATE),))
+        self.last_upload_api_calls = sum(self.api.api_calls.values()) - calls_before
+        logging.info(f"Uploaded {len(df)} transaction(s) to '{sheet.title}' in {self.last_upload_api_calls} API call(s)")
+        return sheet
+
+    def update_sheet(self, sheet, df):
+        # appends the transactions missing from the tab and fixes the prices that changed, rows are matched on
+        # account, date, item and occurrence so that user edited columns are left untouched
+        values = self.api.get_values(sheet, f"A1:{_column_letter(len(DF_COLUMNS))}")
+        existing = pd.DataFrame([(row + [None] * len(DF_COLUMNS))[:len(DF_COLUMNS)] for row in values[1:]],
+                                columns=DF_COLUMNS)
+        existing_keys = sheet_row_keys(existing[DF_COL_ACCOUNT], sheet_dates(existing[DF_COL_DATE]), existing[DF_COL_ITEM])
+        new_keys = sheet_row_keys(df[DF_COL_ACCOUNT], df[DF_COL_DATE], df[DF_COL_ITEM])
+        sheet_rows = pd.Series(np.arange(1, len(existing) + 1), index=existing_keys)
+        sheet_rows = sheet_rows[~sheet_rows.index.duplicated()]
+        matched_rows = pd.Series(new_keys).map(sheet_rows)
+
+        blocks = []
+        appended = df[matched_rows.isna().values]
+        first_new_row = max(len(values), 1)
+        if len(appended):
+            blocks.append((first_new_row, 0, to_sheet_rows(appended)))
+
+        price_col = DF_COLUMNS.index(DF_COL_PRICE)
+        matched = matched_rows.notna().values
+        old_prices = pd.to_numeric(existing[DF_COL_PRICE], errors='coerce').values[matched_rows[matched].astype(int).values - 1]
+        new_prices = df[DF_COL_PRICE].values[matched]
+        changed = ~np.isclose(old_prices, new_prices, equal_nan=True)
+        for row, price in zip(matched_rows[matched][changed].astype(int), new_prices[changed]):
+            blocks.append((row, price_col, [[float(price)]]))
+
+        # also replaces the per row formulas of tabs uploaded before PRICE_TO_SHARE_FORMULA
+        column_formulas = [(1, DF_COLUMNS.index(DF_COL_PRICE_TO_SHARE), PRICE_TO_SHARE_FORMULA)] if blocks else []
+        self.api.update_cells(sheet, blocks, first_new_row + len(appended), (DF_COLUMNS.index(DF_COL_DATE),), column_formulas)
+        logging.info(f"Updated '{sheet.title}': {len(appended)} new transaction(s), {int(changed.sum())} price(s) changed")
+
+    def find_month_sheet(self, date_from):
+        expected_name = SheetUploader.sheet_name(date_from)
+        sheet = self.api.worksheet(expected_name)
+        if sheet is None:
+            sheet = self.api.find_sheet_by_prefix(expected_name)
+        return sheet
+
+    def get_statements_dataframe(self, date_from: dt.datetime, date_to: dt.datetime, paths=None):
+        statements = list(self.enumerate_statements(date_from, date_to, paths))
+        if not self.store:
+            df = statements_to_dataframe(statements, self.cache, self.config.statement_chunk_size)
+        else:
+            self.ingest_statements(statements)
+            transactions = self.store.transactions(date_from, date_to, self.config.chase_accounts.values())
+            df = transactions_to_dataframe(transactions)
+        # applied after the cache and the store so that editing the rules does not require parsing statements again
+        return self.rules.apply(df) if self.rules else df
+
+    def ingest_statements(self, statements):
+        # whole files go into the store, overlapping statements are deduplicated on the transaction fingerprint
+        for s in statements:
+            if not os.path.exists(s.path) or self.store.is_ingested(s.path, s.cache_variant()):
+                continue
+            chunks = s.iter_chunks(self.config.statement_chunk_size)
+            self.store.ingest(s.path, s.cache_variant(), (to_store_dataframe(c) for c in chunks))
+
+    def enumerate_statements(self, date_from, date_to, paths=None):
+        # paths are the statements just downloaded keyed by str(account), None for an account whose download failed.
+        # The other accounts are looked up in the statements directory
+        paths = paths or {}
         for account in self.config.chase_accounts.values():
-            if account.account_type == AccountType.Checking:
-                expected_filename = f"Chase{account.last_4_digits}_Activity_{download_date:%Y%m%d}.CSV"
-                yield CheckingStatement(account, os.path.join(self.config.statements_download_dir, expected_filename))
-            elif account.account_type == AccountType.CreditCard:
-                expected_filename = f"Chase{account.last_4_digits}_Activity{date_from:%Y%m%d}_{date_to:%Y%m%d}_{download_date:%Y%m%d}.CSV"
-                yield CreditCardStatement(account, os.path.join(self.config.statements_download_dir, expected_filename))
+            statement_type = STATEMENT_TYPES[account.account_type]
+            if str(account) in paths:
+                path = paths[str(account)]
+                if path is None:
+                    logging.warning(f"no statement downloaded for account {account} from {date_from:%Y-%m-%d} to {date_to:%Y-%m-%d}")
+                    continue
+                statement_file = parse_statement_filename(os.path.dirname(path), os.path.basename(path))
+            else:
+                statement_file = self.index.find(account, date_from, date_to)
+                if statement_file is None:
+                    logging.warning(f"could not find statement file for account {account} from {date_from:%Y-%m-%d} to {date_to:%Y-%m-%d}")
+                    continue
+                path = statement_file.path
+            if statement_file is not None and statement_file.date_from == date_from and statement_file.date_to == date_to:
+                yield statement_type(account, path)
+            else:
+                yield statement_type(account, path, date_from, date_to)
+
+    def compute_totals(self, date_from: dt.datetime, date_to: dt.datetime):
+        return compute_totals(self.get_statements_dataframe(date_from, date_to))
 
     def pull_totals_for_date(self, date_from):
-        expected_name = SheetUploader.sheet_name(date_from)
-        if not self.api.sheet_exists(expected_name):
-            logging.warning(f"Could not find sheet with expected name '{expected_name}'")
-            s = self.api.find_sheet_by_prefix(expected_name)
-            if s is None:
-                logging.error(f"Could not find sheet with prefix '{expected_name}'")
-                return
-            else:
-                expected_name = s.title
-        yield from self.pull_totals(expected_name)
+        sheet = self.find_month_sheet(date_from)
+        if sheet is None:
+            logging.error(f"Could not find sheet with prefix '{SheetUploader.sheet_name(date_from)}'")
+            return
+        yield from self.pull_totals(sheet.title)
+
+    def refresh(self):
+        self.api.refresh()
+        self._totals.clear()
 
     def pull_totals(self, sheet_name):
-        sheet = self.api.sheet.worksheet_by_title(sheet_name)
-        items = sheet.get_col(SHEET_CATEGORY_COL, include_tailing_empty=False)
-        values = sheet.get_col(SHEET_CATEGORY_COL + 1, include_tailing_empty=False)
-        for i, v in zip(items[SHEET_CATEGORY_ROW:-1], values[SHEET_CATEGORY_ROW:-1]):
-            yield ExpenseTotal(i, float(v))
+        # category and total columns come in a single read, kept until the tab is written to or refreshed
+        revision = self.api.revision(sheet_name)
+        cached = self._totals.get(sheet_name)
+        if cached and cached[0] == revision:
+            return cached[1]
+        sheet = self.api.worksheet(sheet_name)
+        if sheet is None:
+            logging.error(f"Could not find sheet '{sheet_name}'")
+            return []
+        first_col = _column_letter(SHEET_CATEGORY_COL)
+        last_col = _column_letter(SHEET_CATEGORY_COL + 1)
+        rows = self.api.get_values(sheet, f"{first_col}{SHEET_CATEGORY_ROW + 1}:{last_col}")
+        totals = [ExpenseTotal(row[0], float(row[1])) for row in rows[:-1] if len(row) > 1 and row[0] != '']
+        self._totals[sheet_name] = (revision, totals)
+        return totals
 
 
 if __name__ == '__main__':
     config = cfg.get_configuration()
 
-    today = dt.datetime(2020, 3, 31)
     feb1 = dt.datetime(2020, 2, 1)
     feb29 = dt.datetime(2020, 2, 29)
 
     uploader = SheetUploader(config)
-    #uploader.upload_statements(feb1, feb29, today)
+    #uploader.upload_statements(feb1, feb29)
 
     expenses = uploader.pull_totals_for_date(feb1)
     for e in expenses:
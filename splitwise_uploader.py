@@ -1,11 +1,17 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from splitwise import Splitwise
 from splitwise.expense import Expense
 from splitwise.user import ExpenseUser
 import configuration as cfg
 import datetime as dt
+from rate_limiter import get_rate_limiter, SERVICE_SPLITWISE
 
 __debug = False
 
+EXPENSES_PAGE_SIZE = 200
+
 
 def get_access_token(config):
     sw = Splitwise(config.splitwise_key, config.splitwise_secret)
@@ -28,34 +34,160 @@ def init(config: cfg.Configuration):
     return Splitwise(config.splitwise_key, config.splitwise_secret, access_token)
 
 
-def share_expense_with_group_members(sw: Splitwise, desc, cost, group_id, date):
-    grp = sw.getGroup(group_id)
-    current_user = sw.getCurrentUser()
-    other_members = [m for m in grp.getMembers() if m.id != current_user.id]
-    _debug(current_user)
-    _debug(other_members)
-    cost_per_user = round(cost / len(grp.members), 2)
-
-    expense = Expense()
-    expense.cost = f"{cost}"
-    expense.description = f"{desc}"
-    expense.group_id = f"{group_id}"
-    expense.setDate(date.strftime("%Y/%m/%d"))
-
-    users = []
-    for om in other_members:
+def local_date(date):
+    # splitwise returns UTC date times like 2020-02-03T12:00:00Z, statements hold local dates
+    if isinstance(date, str):
+        date = dt.datetime.fromisoformat(date.replace('Z', '+00:00'))
+    if isinstance(date, dt.datetime):
+        return (date.astimezone() if date.tzinfo else date).date()
+    return date
+
+
+def expense_key(desc, date, cost):
+    # what makes two expenses of the group the same one, local dates and costs to the cent
+    return f"{desc}", f"{local_date(date):%Y-%m-%d}", f"{float(cost):.2f}"
+
+
+class GroupPusher:
+    # shares expenses with the members of a group. The group and the current user are resolved once, on first use,
+    # expenses are created concurrently and the ones already in the group, looked up in an index of its expenses read
+    # again on every push since they can be added or deleted from splitwise in between, are skipped
+    def __init__(self, sw: Splitwise, group_id, max_workers=4, limiter=None):
+        self.sw = sw
+        self.group_id = group_id
+        self.max_workers = max(1, max_workers)
+        self.limiter = limiter
+        self.group = None
+        self.current_user = None
+        self.other_members = []
+        self._existing = set()
+        self._lock = threading.Lock()
+
+    def _call(self, fn, *args, coalesce_key=None, idempotent=True, **kwargs):
+        if self.limiter is None:
+            return fn(*args, **kwargs)
+        return self.limiter.call(fn, *args, coalesce_key=coalesce_key, idempotent=idempotent, **kwargs)
+
+    def connect(self):
+        with self._lock:
+            if self.group is None:
+                self.current_user = self._call(self.sw.getCurrentUser, coalesce_key="getCurrentUser")
+                self.group = self._call(self.sw.getGroup, self.group_id, coalesce_key=("getGroup", self.group_id))
+                self.other_members = [m for m in self.group.getMembers() if m.id != self.current_user.id]
+                _debug(self.current_user)
+                _debug(self.other_members)
+        return self
+
+    def index_existing_expenses(self, dated_after=None, dated_before=None):
+        # pages through the group expenses of the period, deleted ones do not count
+        self.connect()
+        keys = set()
+        offset = 0
+        while True:
+            page = self._call(self.sw.getExpenses, offset=offset, limit=EXPENSES_PAGE_SIZE, group_id=self.group_id,
+                              dated_after=dated_after, dated_before=dated_before,
+                              coalesce_key=("getExpenses", self.group_id, offset, dated_after, dated_before))
+            for e in page:
+                if not e.getDeletedAt():
+                    keys.add(expense_key(e.getDescription(), e.getDate(), e.getCost()))
+            if len(page) < EXPENSES_PAGE_SIZE:
+                break
+            offset += len(page)
+        with self._lock:
+            self._existing = keys
+        logging.info(f"Found {len(keys)} expense(s) in group {self.group.name}")
+
+    def create_expense(self, desc, cost, date):
+        self.connect()
+        cost = round(float(cost), 2)
+        cost_per_user = round(cost / len(self.group.members), 2)
+
+        expense = Expense()
+        expense.cost = f"{cost:.2f}"
+        expense.description = f"{desc}"
+        expense.group_id = f"{self.group_id}"
+        # noon local time, the date stays the same once stored in UTC and read back in the local timezone
+        expense.setDate(dt.datetime.combine(local_date(date), dt.time(12)).astimezone().isoformat())
+
+        users = []
+        for om in self.other_members:
+            user = ExpenseUser()
+            user.setId(om.id)
+            user.setPaidShare(f"0")
+            user.setOwedShare(f"{cost_per_user:.2f}")
+            users.append(user)
         user = ExpenseUser()
-        user.setId(om.id)
-        user.setPaidShare(f"0")
-        user.setOwedShare(f"{cost_per_user}")
+        user.setId(self.current_user.id)
+        user.setPaidShare(f"{cost:.2f}")
+        user.setOwedShare(f"{cost - len(users) * cost_per_user:.2f}")
         users.append(user)
-    user = ExpenseUser()
-    user.setId(current_user.id)
-    user.setPaidShare(f"{cost}")
-    user.setOwedShare(f"{cost - len(users) * cost_per_user}")
-    users.append(user)
-    expense.users = users
-    sw.createExpense(expense)
+        expense.users = users
+        created, errors = self._call(self.sw.createExpense, expense, idempotent=False)
+        if errors:
+            raise RuntimeError(f"Could not create expense '{desc}': {errors.getErrors()}")
+        with self._lock:
+            self._existing.add(expense_key(desc, date, cost))
+        return created
+
+    def push(self, expenses, progress=None, cancelled: threading.Event = None):
+        # expenses are (description, cost, date) tuples, returns the number of expenses created, skipped, failed and
+        # cancelled. progress(done, total) is called as expenses get created, setting cancelled stops the pending ones
+        expenses = list(expenses)
+        if not expenses:
+            return {"created": 0, "skipped": 0, "failed": 0, "cancelled": 0}
+        self.connect()
+        dates = [date for _, _, date in expenses]
+        # a day of margin on both sides, splitwise compares date times
+        period = (f"{min(dates) - dt.timedelta(days=1):%Y-%m-%d}", f"{max(dates) + dt.timedelta(days=1):%Y-%m-%d}")
+        self.index_existing_expenses(*period)
+
+        to_create = {}
+        with self._lock:
+            for desc, cost, date in expenses:
+                key = expense_key(desc, date, cost)
+                if key not in self._existing:
+                    to_create.setdefault(key, (desc, cost, date))
+        summary = {"created": 0, "skipped": len(expenses) - len(to_create), "failed": 0, "cancelled": 0}
+        total = len(to_create)
+        done = [0]
+
+        def create(expense):
+            if cancelled is not None and cancelled.is_set():
+                return False
+            self.create_expense(*expense)
+            return True
+
+        def on_done(_):
+            with self._lock:
+                done[0] += 1
+                count = done[0]
+            if progress:
+                progress(count, total)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="splitwise") as executor:
+            futures = [executor.submit(create, e) for e in to_create.values()]
+            for future in futures:
+                future.add_done_callback(on_done)
+        for future in futures:
+            try:
+                summary["created" if future.result() else "cancelled"] += 1
+            except Exception as e:
+                logging.error(e)
+                summary["failed"] += 1
+        logging.info(f"Splitwise push to {self.group.name}: {summary}")
+        return summary
+
+
+def get_group_pusher(config: cfg.Configuration, sw: Splitwise):
+    return GroupPusher(sw, config.splitwise_group_id, config.splitwise_push_workers, get_rate_limiter(config, SERVICE_SPLITWISE))
+
+
+def connect_group_pusher(config: cfg.Configuration):
+    return get_group_pusher(config, init(config)).connect()
+
+
+def share_expense_with_group_members(sw: Splitwise, desc, cost, group_id, date):
+    return GroupPusher(sw, group_id).create_expense(desc, cost, date)
 
 
 def _debug(element):
@@ -0,0 +1,64 @@
+import os
+import hashlib
+import logging
+import pandas as pd
+
+CACHE_EXTENSION = ".feather"
+
+
+class StatementCache:
+    # normalised statement frames stored as feather files, keyed on the source file identity
+    # (path, size, mtime) and the parser variant. Least recently used entries go first once over max_bytes
+    def __init__(self, directory, max_bytes):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _entry_path(self, path, variant):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{variant}"
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + CACHE_EXTENSION)
+
+    def get(self, path, variant):
+        entry = self._entry_path(path, variant)
+        if not entry or not os.path.exists(entry):
+            return None
+        try:
+            df = pd.read_feather(entry)
+        except Exception as e:
+            logging.warning(f"Dropping unreadable cache entry {entry}: {e}")
+            os.remove(entry)
+            return None
+        os.utime(entry)
+        return df
+
+    def put(self, path, variant, df):
+        entry = self._entry_path(path, variant)
+        if not entry:
+            return
+        tmp = entry + ".tmp"
+        df.reset_index(drop=True).to_feather(tmp)
+        os.replace(tmp, entry)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(CACHE_EXTENSION):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(e[1] for e in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+def get_statement_cache(config):
+    if not config.statement_cache_dir:
+        return None
+    return StatementCache(config.statement_cache_dir, config.statement_cache_max_mb * 1024 * 1024)
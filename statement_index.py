@@ -0,0 +1,149 @@
+import os
+import re
+import csv
+import logging
+import threading
+import datetime as dt
+
+import configuration as cfg
+
+# Chase{last4}_Activity_{downloaded}.CSV for checking accounts,
+# Chase{last4}_Activity{from}_{to}_{downloaded}.CSV for cards, chrome adds " (n)" to duplicates
+STATEMENT_FILENAME_RE = re.compile(
+    r"^Chase(?P<last4>\d{4})_Activity(?:(?P<date_from>\d{8})_(?P<date_to>\d{8}))?_(?P<downloaded>\d{8})"
+    r"(?: \((?P<copy>\d+)\))?\.CSV$", re.IGNORECASE)
+FILENAME_DATE_FORMAT = '%Y%m%d'
+# first column holding the transaction date, checking and card exports respectively
+CONTENT_DATE_COLUMNS = ("Posting Date", "Transaction Date")
+CONTENT_DATE_FORMAT = '%m/%d/%Y'
+
+
+class StatementFile:
+    def __init__(self, path, last_4_digits, date_from, date_to, download_date, copy, mtime_ns):
+        self.path = path
+        self.last_4_digits = last_4_digits
+        self.date_from = date_from
+        self.date_to = date_to
+        self.download_date = download_date
+        self.copy = copy
+        self.mtime_ns = mtime_ns
+        self._content_range = None
+
+    @property
+    def has_range(self):
+        return self.date_from is not None
+
+    def covers(self, date_from, date_to):
+        return self.has_range and self.date_from <= date_from and self.date_to >= date_to
+
+    def content_range(self):
+        # first and last transaction dates, read once. None when the file has no transaction or cannot be read
+        if self._content_range is None:
+            self._content_range = (_read_content_range(self.path),)
+        return self._content_range[0]
+
+    def content_overlaps(self, date_from, date_to):
+        content_range = self.content_range()
+        return content_range is not None and content_range[0] <= date_to and content_range[1] >= date_from
+
+    def recency(self):
+        return self.download_date, self.copy, self.mtime_ns
+
+    def __repr__(self):
+        return f"StatementFile({os.path.basename(self.path)})"
+
+
+def parse_statement_filename(directory, name):
+    match = STATEMENT_FILENAME_RE.match(name)
+    if not match:
+        return None
+    path = os.path.join(directory, name)
+
+    def to_date(s):
+        return dt.datetime.strptime(s, FILENAME_DATE_FORMAT) if s else None
+    try:
+        return StatementFile(path, match['last4'], to_date(match['date_from']), to_date(match['date_to']),
+                             to_date(match['downloaded']), int(match['copy'] or 0), os.stat(path).st_mtime_ns)
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+class StatementIndex:
+    # index of the statements found in the download directory, only rescanned when the directory changes.
+    # Exact (account, range) lookups are dict hits, the newest download wins
+    def __init__(self, directory):
+        self.directory = directory
+        self._dir_mtime_ns = None
+        self._files = {}
+        self._by_range = {}
+        self._by_account = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            try:
+                mtime_ns = os.stat(self.directory).st_mtime_ns
+            except FileNotFoundError:
+                logging.warning(f"Statements directory {self.directory} does not exist")
+                return
+            if mtime_ns == self._dir_mtime_ns:
+                return
+            names = set(os.listdir(self.directory))
+            for name in set(self._files) - names:
+                del self._files[name]
+            for name in names - set(self._files):
+                statement_file = parse_statement_filename(self.directory, name)
+                if statement_file:
+                    self._files[name] = statement_file
+            self._rebuild()
+            self._dir_mtime_ns = mtime_ns
+
+    def _rebuild(self):
+        by_range = {}
+        by_account = {}
+        for f in sorted(self._files.values(), key=StatementFile.recency, reverse=True):
+            by_range.setdefault((f.last_4_digits, f.date_from, f.date_to), f)
+            by_account.setdefault(f.last_4_digits, []).append(f)
+        self._by_range = by_range
+        self._by_account = by_account
+
+    def find(self, account: cfg.Account, date_from: dt.datetime, date_to: dt.datetime):
+        self.refresh()
+        date_from, date_to = _day(date_from), _day(date_to)
+        exact = self._by_range.get((account.last_4_digits, date_from, date_to))
+        if exact:
+            return exact
+        for f in self._by_account.get(account.last_4_digits, []):
+            if f.covers(date_from, date_to):
+                return f
+        # checking downloads do not carry their range in the name, the newest one with transactions in the period is
+        # used. Another period's file would only be clipped to nothing
+        for f in self._by_account.get(account.last_4_digits, []):
+            if not f.has_range and f.content_overlaps(date_from, date_to):
+                return f
+        logging.warning(f"No statement of {account} covers {date_from:%Y-%m-%d} to {date_to:%Y-%m-%d}")
+        return None
+
+    def files(self, account: cfg.Account = None):
+        self.refresh()
+        if account is None:
+            return list(self._files.values())
+        return list(self._by_account.get(account.last_4_digits, []))
+
+
+def _read_content_range(path):
+    try:
+        with open(path, newline='') as f:
+            reader = csv.DictReader(f)
+            column = next((c for c in CONTENT_DATE_COLUMNS if c in (reader.fieldnames or ())), None)
+            if column is None:
+                return None
+            dates = [dt.datetime.strptime(row[column], CONTENT_DATE_FORMAT) for row in reader if row.get(column)]
+    except (OSError, ValueError, csv.Error) as e:
+        logging.warning(f"Could not read the dates of {path}: {e}")
+        return None
+    return (min(dates), max(dates)) if dates else None
+
+
+def _day(date):
+    return dt.datetime(date.year, date.month, date.day)
@@ -0,0 +1,103 @@
+import os
+import sys
+
+# modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import types
+
+import pytest
+
+import configuration as cfg
+
+TEMPLATE_SHEET_ID = 1
+
+CHECKING = cfg.Account("CHECKING", {"url_param": "DDA,CHK,1", "account_type": "Checking", "alias": "chk", "last_4_digits": "0123"})
+CARD = cfg.Account("CARD", {"url_param": "CARD,BAC,2", "account_type": "CreditCard", "alias": "card", "last_4_digits": "4567"})
+
+CHECKING_HEADER = "Details,Posting Date,Description,Amount,Type,Balance,Check or Slip #\n"
+CARD_HEADER = "Transaction Date,Post Date,Description,Category,Type,Amount,Memo\n"
+
+
+def make_config(download_dir, **overrides):
+    # the attributes of cfg.Configuration the tested modules read, without touching the singleton
+    config = types.SimpleNamespace(
+        chase_accounts={"CHECKING": CHECKING, "CARD": CARD}, categorisation_rules=[],
+        statements_download_dir=str(download_dir), statement_cache_dir=None, statement_cache_max_mb=1,
+        transaction_store_path=None, statement_chunk_size=50000, google_spreadsheet_id="spreadsheet",
+        google_credentials_path=None, sheets_requests_per_minute=6000, splitwise_requests_per_minute=6000,
+        api_max_retries=0, job_journal_path=None)
+    config.__dict__.update(overrides)
+    return config
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, json_sheet):
+        properties = json_sheet["properties"]
+        self.spreadsheet = spreadsheet
+        self.id = properties["sheetId"]
+        self.title = properties["title"]
+        self.index = properties.get("index", 0)
+        self.rows = properties.get("gridProperties", {}).get("rowCount", 1000)
+
+
+class FakeSpreadsheet:
+    worksheet_cls = FakeWorksheet
+
+    def __init__(self, client, spreadsheet_id):
+        self.client = client
+        self.id = spreadsheet_id
+
+    def worksheets(self):
+        return list(self.client.worksheets.values())
+
+
+class FakeSheetsService:
+    # stands for client.sheet, records the batchUpdate requests and answers values.get from values[title]
+    check = True
+    retries = 3
+
+    def __init__(self, client):
+        self.client = client
+        self.batch_updates = []
+        self.values_gets = []
+        self.values = {}
+
+    def batch_update(self, spreadsheet_id, requests):
+        self.batch_updates.append(requests)
+        replies = []
+        for request in requests:
+            if "duplicateSheet" in request:
+                duplicate = request["duplicateSheet"]
+                properties = {"sheetId": duplicate["newSheetId"], "title": duplicate["newSheetName"],
+                              "index": duplicate["insertSheetIndex"], "gridProperties": {"rowCount": 1000}}
+                self.client.add_worksheet(properties)
+                replies.append({"duplicateSheet": {"properties": properties}})
+            else:
+                replies.append({})
+        return {"replies": replies}
+
+    def values_get(self, spreadsheet_id, value_range, **kwargs):
+        self.values_gets.append((value_range, kwargs))
+        return {"values": self.values.get(value_range.split('!')[0].strip("'"), [])}
+
+
+class FakeSheetsClient:
+    def __init__(self):
+        self.sheet = FakeSheetsService(self)
+        self.worksheets = {}
+        self.add_worksheet({"sheetId": TEMPLATE_SHEET_ID, "title": "_TEMPLATE_", "index": 0})
+
+    def add_worksheet(self, properties):
+        self.worksheets[properties["title"]] = FakeWorksheet(None, {"properties": properties})
+
+    def open_by_key(self, key):
+        return FakeSpreadsheet(self, key)
+
+
+@pytest.fixture
+def fake_sheets(monkeypatch):
+    import sheet_uploader
+    client = FakeSheetsClient()
+    monkeypatch.setattr(sheet_uploader.pygsheets, "authorize", lambda **kwargs: client)
+    return client
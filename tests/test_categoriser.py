@@ -0,0 +1,46 @@
+import os
+import sys
+import subprocess
+
+import pandas as pd
+
+import configuration as cfg
+from categoriser import RuleSet, DF_COLUMNS, DF_COL_CATEGORY, DF_COL_FACTOR, DF_COL_PRICE_TO_SHARE
+from conftest import CHECKING, CARD
+
+
+def frame(rows):
+    df = pd.DataFrame([(account, pd.Timestamp("2020-02-03"), item, "Shopping", price, 0., 0.)
+                       for account, item, price in rows], columns=DF_COLUMNS)
+    df[DF_COL_CATEGORY] = df[DF_COL_CATEGORY].astype('category')
+    return df
+
+
+def rules(*dicos):
+    return RuleSet([cfg.CategorisationRule(d) for d in dicos], {"CHECKING": CHECKING, "CARD": CARD})
+
+
+def test_first_rule_wins_wherever_its_pattern_is_found():
+    rule_set = rules({"pattern": "coffee", "category": "Coffee"}, {"pattern": "STAR", "category": "Stars"},
+                     {"pattern": "(uber|lyft) ", "category": "Rides", "share_factor": 0.5})
+    df = rule_set.apply(frame([("card-4567", "STARBUCKS COFFEE", 5.), ("card-4567", "STARBUCKS", 4.),
+                               ("card-4567", "UBER TRIP", 10.), ("card-4567", "BOOKS", 12.)]))
+
+    assert list(df[DF_COL_CATEGORY]) == ["Coffee", "Stars", "Rides", "Shopping"]
+    assert list(df[DF_COL_PRICE_TO_SHARE]) == [0., 0., 5., 0.]
+
+
+def test_rows_failing_the_constraints_of_a_rule_try_the_next_ones():
+    rule_set = rules({"pattern": "AMZN", "min_amount": 100, "category": "Big"},
+                     {"pattern": "AMZN", "accounts": ["CHECKING"], "category": "Checking"},
+                     {"category": "Other", "share_factor": 1})
+    df = rule_set.apply(frame([("card-4567", "AMZN 1", 150.), ("chk-0123", "AMZN 2", 20.), ("card-4567", "AMZN 3", 20.)]))
+
+    assert list(df[DF_COL_CATEGORY]) == ["Big", "Checking", "Other"]
+    assert list(df[DF_COL_FACTOR]) == [0., 0., 1.]
+    assert list(rule_set.match(frame([("card-4567", "AMZN 3", 20.)]))) == [2]
+
+
+def test_categoriser_imports_without_the_sheets_uploader():
+    code = "import sys, categoriser; assert 'sheet_uploader' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
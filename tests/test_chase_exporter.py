@@ -0,0 +1,62 @@
+import datetime as dt
+import threading
+import http.server
+import urllib.parse
+
+import pytest
+
+from chase_exporter import ChaseExporter, ExportError
+from conftest import CARD, CARD_HEADER
+
+CANNED_STATEMENT = CARD_HEADER + "01/03/2020,01/05/2020,COFFEE SHOP,Food & Drink,Sale,-4.50,\n"
+
+
+class CannedStatementHandler(http.server.BaseHTTPRequestHandler):
+    # stands for the chase export endpoint, answers the logon page to requests without the session cookie
+    forms = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        self.forms.append(dict(urllib.parse.parse_qsl(body)))
+        logged_in = 'session=ok' in self.headers.get('Cookie', '')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv' if logged_in else 'text/html')
+        self.end_headers()
+        self.wfile.write(CANNED_STATEMENT.encode() if logged_in else b"<html>logon</html>")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def export_url():
+    CannedStatementHandler.forms = []
+    server = http.server.HTTPServer(('127.0.0.1', 0), CannedStatementHandler)
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/export"
+    server.shutdown()
+    server.server_close()
+
+
+def test_statement_is_saved_under_the_name_chase_gives_to_ranged_exports(tmp_path, export_url):
+    exporter = ChaseExporter(str(tmp_path), export_url)
+    exporter.load_session([{"name": "session", "value": "ok", "domain": "127.0.0.1"}])
+
+    path = exporter.export_statement(CARD, '01/01/2020', '01/31/2020')
+
+    name = f"Chase4567_Activity20200101_20200131_{dt.datetime.today():%Y%m%d}.CSV"
+    assert path == str(tmp_path / name)
+    with open(path) as f:
+        assert f.read() == CANNED_STATEMENT
+    [form] = CannedStatementHandler.forms
+    assert (form["accountId"], form["dateLo"], form["dateHi"]) == ("2", '01/01/2020', '01/31/2020')
+    # nothing left of the partial download
+    assert [p.name for p in tmp_path.iterdir()] == [name]
+
+
+def test_page_answered_instead_of_a_csv_is_an_export_error(tmp_path, export_url):
+    exporter = ChaseExporter(str(tmp_path), export_url)
+
+    with pytest.raises(ExportError):
+        exporter.export_statement(CARD, '01/01/2020', '01/31/2020')
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,47 @@
+import os
+import datetime as dt
+
+import pytest
+
+from download_watcher import DownloadWatcher, DownloadTimeout
+from pipeline import name_after_period
+from conftest import CHECKING, CHECKING_HEADER
+
+NAME = "Chase0123_Activity_20200301.CSV"
+PATTERN = "Chase0123_Activity*.CSV"
+
+
+def download(directory, content):
+    # chrome writes the partial file then renames it once finished
+    partial = os.path.join(directory, NAME + ".crdownload")
+    with open(partial, 'w') as f:
+        f.write(content)
+    os.replace(partial, os.path.join(directory, NAME))
+
+
+def test_same_named_downloads_in_a_row_are_both_delivered(tmp_path):
+    # with a single driver the staging directory is the download directory, statements are delivered in place
+    watcher = DownloadWatcher(str(tmp_path), str(tmp_path), poll_s=0.01, stable_checks=1)
+
+    first = watcher.expect(PATTERN, timeout_s=5)
+    download(str(tmp_path), CHECKING_HEADER + "DEBIT,02/10/2020,RENT,-1500.00,ACH_DEBIT,100.00,\n")
+    path = first.result(5)
+    assert path == str(tmp_path / NAME)
+    renamed = name_after_period(path, CHECKING, dt.datetime(2020, 2, 1), dt.datetime(2020, 2, 29))
+
+    second = watcher.expect(PATTERN, timeout_s=5)
+    download(str(tmp_path), CHECKING_HEADER + "DEBIT,01/10/2020,RENT,-1400.00,ACH_DEBIT,100.00,\n")
+    assert second.result(5) == str(tmp_path / NAME)
+    assert os.path.basename(renamed) == "Chase0123_Activity20200201_20200229_20200301.CSV"
+
+
+def test_a_delivered_file_is_not_delivered_twice(tmp_path):
+    watcher = DownloadWatcher(str(tmp_path), poll_s=0.01, stable_checks=1)
+    first = watcher.expect(PATTERN, timeout_s=5)
+    second = watcher.expect(PATTERN, timeout_s=0.3)
+
+    download(str(tmp_path), CHECKING_HEADER)
+
+    assert first.result(5) == str(tmp_path / NAME)
+    with pytest.raises(DownloadTimeout):
+        second.result(5)
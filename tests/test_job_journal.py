@@ -0,0 +1,65 @@
+import datetime as dt
+
+from job_journal import JobJournal, STAGE_DOWNLOAD, STAGE_UPLOAD, STATUS_DONE, STATUS_FAILED, file_digest
+from pipeline import pending_downloads
+from conftest import CHECKING, CARD, CARD_HEADER
+
+PERIOD = "2020-02-01..2020-02-29"
+
+
+def test_finished_steps_are_found_again_after_a_restart(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = JobJournal(str(path))
+    with journal.running(STAGE_UPLOAD, "*", PERIOD, "abc") as step:
+        step.output = {"sheet": "Feb 2020"}
+    journal.record(STAGE_DOWNLOAD, CARD, PERIOD, STATUS_FAILED, error="logged out")
+    journal.close()
+
+    journal = JobJournal(str(path))
+    assert journal.finished(STAGE_UPLOAD, "*", PERIOD, "abc").output == {"sheet": "Feb 2020"}
+    assert journal.finished(STAGE_UPLOAD, "*", PERIOD, "other content") is None
+    assert journal.finished(STAGE_DOWNLOAD, CARD, PERIOD) is None
+    assert journal.stats()["steps"] == {STATUS_DONE: 1, STATUS_FAILED: 1}
+
+
+def test_line_cut_short_by_a_crash_is_ignored(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = JobJournal(str(path))
+    journal.record(STAGE_UPLOAD, "*", PERIOD, STATUS_DONE, "abc")
+    journal.close()
+    with open(path, 'a') as f:
+        f.write('{"at": "2020-03-01T10:00:00", "stage": "upl')
+
+    journal = JobJournal(str(path))
+    journal.record(STAGE_UPLOAD, "*", "2020-03-01..2020-03-31", STATUS_DONE, "def")
+    journal.close()
+
+    journal = JobJournal(str(path))
+    assert journal.finished(STAGE_UPLOAD, "*", PERIOD, "abc") is not None
+    assert journal.finished(STAGE_UPLOAD, "*", "2020-03-01..2020-03-31", "def") is not None
+
+
+def test_steps_finished_too_early_run_again(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal.jsonl"))
+    journal.record(STAGE_UPLOAD, "*", PERIOD, STATUS_DONE, "abc")
+    step = journal.step(STAGE_UPLOAD, "*", PERIOD)
+
+    assert journal.finished(STAGE_UPLOAD, "*", PERIOD, completed_after=step.at - dt.timedelta(seconds=1)) is step
+    assert journal.finished(STAGE_UPLOAD, "*", PERIOD, completed_after=step.at + dt.timedelta(seconds=1)) is None
+
+
+def test_statements_are_resumed_from_their_period_file_with_the_same_content(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal.jsonl"))
+    card = tmp_path / "Chase4567_Activity20200201_20200229_20200301.CSV"
+    card.write_text(CARD_HEADER)
+    journal.record(STAGE_DOWNLOAD, CARD, PERIOD, STATUS_DONE, file_digest(card), {"path": str(card)})
+
+    assert pending_downloads(journal, [CHECKING, CARD], "2020-02-01", "2020-02-29") == ([CHECKING], {str(CARD): str(card)})
+    assert journal.resumed[STAGE_DOWNLOAD] == 1
+    assert pending_downloads(journal, [CARD], "2020-03-01", "2020-03-31") == ([CARD], {})
+
+    card.write_text(CARD_HEADER + "02/03/2020,02/04/2020,COFFEE,Food & Drink,Sale,-4.50,\n")
+    assert pending_downloads(journal, [CARD], "2020-02-01", "2020-02-29") == ([CARD], {})
+    card.unlink()
+    assert pending_downloads(journal, [CARD], "2020-02-01", "2020-02-29") == ([CARD], {})
+    assert pending_downloads(None, [CARD], "2020-02-01", "2020-02-29") == ([CARD], {})
@@ -0,0 +1,183 @@
+import types
+import threading
+import datetime as dt
+
+import pytest
+
+from scheduler import JobScheduler, JobStatus, JobCancelled
+from sheet_uploader import SheetUploader
+from chazeets_batch import submit_month
+from pipeline import get_statements, ChaseScraperWrapper
+from conftest import CHECKING, CARD, CHECKING_HEADER, CARD_HEADER, make_config
+
+FEB = (dt.datetime(2020, 2, 1), dt.datetime(2020, 2, 29))
+
+
+class FakeScraper:
+    def __init__(self, paths):
+        self.paths = paths
+
+    def download_statement_file(self, account, date_from, date_to):
+        if self.paths[str(account)] is None:
+            raise RuntimeError(f"download of {account} failed")
+        return self.paths[str(account)]
+
+
+class FakeUploader:
+    def __init__(self):
+        self.parsed = []
+        self.connected = False
+
+    def connect(self):
+        self.connected = True
+
+    def get_statements_dataframe(self, date_from, date_to, paths=None):
+        self.parsed.append(paths)
+        return list(paths.values())
+
+    def upload_dataframe(self, df, date_from, update):
+        assert self.connected
+        return types.SimpleNamespace(title="Feb 2020")
+
+    def pull_totals(self, title):
+        return []
+
+
+def test_downloaded_statements_are_parsed_even_when_another_account_failed(tmp_path):
+    # checking downloads do not carry their range, they get renamed after the period
+    checking = tmp_path / "Chase0123_Activity_20200301.CSV"
+    checking.write_text(CHECKING_HEADER)
+    scheduler = JobScheduler()
+    uploader = FakeUploader()
+    scraper = FakeScraper({str(CHECKING): str(checking), str(CARD): None})
+    connect_job = scheduler.submit("sheets", uploader.connect, name="sheets connect")
+
+    stages = submit_month(scheduler, uploader, scraper, [CHECKING, CARD], *FEB, None, connect_job, None, True,
+                          to_download=[CHECKING, CARD])
+    stages["totals"].result(5)
+
+    assert stages["download"][str(CARD)].status == JobStatus.Failed
+    renamed = str(tmp_path / "Chase0123_Activity20200201_20200229_20200301.CSV")
+    assert uploader.parsed == [{str(CHECKING): renamed, str(CARD): None}]
+    assert not checking.exists()
+    assert stages["upload"].result().title == "Feb 2020"
+    scheduler.shutdown()
+
+
+def test_upload_is_cancelled_when_sheets_cannot_connect():
+    scheduler = JobScheduler()
+    uploader = FakeUploader()
+
+    def connect():
+        raise RuntimeError("no credentials")
+
+    connect_job = scheduler.submit("sheets", connect, name="sheets connect")
+    stages = submit_month(scheduler, uploader, None, [CHECKING, CARD], *FEB, None, connect_job, None, True)
+    with pytest.raises(JobCancelled):
+        stages["upload"].result(5)
+    # the upload is cancelled as soon as the connection fails, parsing runs on its own lane meanwhile
+    stages["parse"].result(5)
+
+    assert uploader.parsed == [{}]
+    scheduler.shutdown()
+
+
+def test_downloaded_paths_are_used_instead_of_the_index(tmp_path):
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    # newer statement of the same period in the statements directory, the one just downloaded is still the one parsed
+    (downloads / "Chase4567_Activity20200201_20200229_20200305.CSV").write_text(
+        CARD_HEADER + "02/03/2020,02/04/2020,NEWER,Shopping,Sale,-1.00,\n")
+    downloaded = tmp_path / "Chase4567_Activity20200201_20200229_20200301.CSV"
+    downloaded.write_text(CARD_HEADER + "02/03/2020,02/04/2020,DOWNLOADED,Shopping,Sale,-2.00,\n")
+    (downloads / "Chase0123_Activity_20200301.CSV").write_text(CHECKING_HEADER + "DEBIT,02/10/2020,RENT,-1500.00,ACH_DEBIT,1.00,\n")
+
+    uploader = SheetUploader(make_config(downloads))
+
+    df = uploader.get_statements_dataframe(*FEB, {str(CARD): str(downloaded)})
+    assert list(df["Item"]) == ["RENT", "DOWNLOADED"]
+    df = uploader.get_statements_dataframe(*FEB, {str(CARD): str(downloaded), str(CHECKING): None})
+    assert list(df["Item"]) == ["DOWNLOADED"]
+
+
+def test_statements_of_a_previous_run_are_parsed_when_the_downloads_fail():
+    scheduler = JobScheduler()
+    uploader = FakeUploader()
+    scraper = FakeScraper({str(CARD): None})
+    connect_job = scheduler.submit("sheets", uploader.connect, name="sheets connect")
+
+    stages = submit_month(scheduler, uploader, scraper, [CHECKING, CARD], *FEB, None, connect_job, None, True,
+                          to_download=[CARD], resumed={str(CHECKING): "/statements/checking.CSV"})
+    stages["totals"].result(5)
+
+    assert stages["download"] == {str(CHECKING): None, str(CARD): stages["download"][str(CARD)]}
+    assert uploader.parsed == [{str(CHECKING): "/statements/checking.CSV", str(CARD): None}]
+    scheduler.shutdown()
+
+
+class RecordingScheduler(JobScheduler):
+    def __init__(self):
+        super().__init__()
+        self.jobs = []
+
+    def submit(self, *args, **kwargs):
+        job = super().submit(*args, **kwargs)
+        self.jobs.append(job)
+        return job
+
+
+class HeldScraper:
+    def __init__(self):
+        self.holds = 0
+
+    def hold(self):
+        self.holds += 1
+
+    def release_hold(self, timeout=0):
+        self.holds -= 1
+
+
+def test_cancelling_the_downloads_still_releases_the_scraper():
+    scheduler = RecordingScheduler()
+    scraper = HeldScraper()
+    logged_on = threading.Event()
+    logon_job = scheduler.submit("browser", logged_on.wait, 5, name="chase logon")
+    get_statements(scheduler, scraper, [CHECKING, CARD], "2020-02-01", "2020-02-29", depends_on=[logon_job])
+
+    # what the cancel button of the GUI does
+    for job in scheduler.jobs:
+        job.cancel("Cancelled from the GUI")
+    logged_on.set()
+
+    scheduler.jobs[-1].result(5)
+    assert scraper.holds == 0
+    assert [job.status for job in scheduler.jobs[1:]] == [JobStatus.Cancelled, JobStatus.Cancelled, JobStatus.Done]
+    scheduler.shutdown()
+
+
+class QuitRecorder:
+    def __init__(self):
+        self.quit_timeouts = []
+
+    def quit(self, timeout):
+        self.quit_timeouts.append(timeout)
+
+
+def test_chrome_warmed_up_but_never_used_is_quit_on_close(monkeypatch):
+    started = threading.Event()
+    scraper = QuitRecorder()
+
+    def create_scraper(self):
+        started.wait(5)
+        return scraper
+
+    monkeypatch.setattr(ChaseScraperWrapper, "_create_scraper", create_scraper)
+    wrapper = ChaseScraperWrapper(types.SimpleNamespace(chrome_spare_idle_timeout_s=60))
+    wrapper.warm_up()
+    started.set()
+
+    wrapper.close(0, keep_spare=False)
+
+    assert scraper.quit_timeouts == [0]
+    with pytest.raises(RuntimeError):
+        wrapper.warm_up()
@@ -0,0 +1,115 @@
+import threading
+
+import pytest
+
+import rate_limiter
+from rate_limiter import RateLimiter, TokenBucket
+from sheet_uploader import SheetUploader
+from conftest import make_config
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ServiceError(Exception):
+    # shaped like the splitwise exceptions
+    def __init__(self, status, headers=None):
+        super().__init__(f"HTTP {status}")
+        self.http_status = (status,)
+        self.http_headers = headers or {}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    return clock
+
+
+def test_bucket_allows_a_burst_then_paces_calls(clock):
+    bucket = TokenBucket(rate=10, capacity=2)
+
+    waits = [bucket.acquire() for _ in range(4)]
+
+    assert waits[:2] == [0., 0.]
+    assert waits[2:] == pytest.approx([0.1, 0.1])
+    assert clock.now == pytest.approx(0.2)
+
+
+def test_throttled_calls_wait_retry_after_capped_at_max_delay(clock):
+    limiter = RateLimiter("test", 6000, max_retries=3, max_delay_s=30)
+    replies = [ServiceError(429, {"Retry-After": "5"}), ServiceError(429, {"retry-after": "3600"}), "ok"]
+
+    def fn():
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    assert limiter.call(fn) == "ok"
+    assert clock.sleeps == [5, 30]
+    assert limiter.stats()["retried_429"] == 2
+
+
+def test_server_errors_are_not_retried_for_calls_that_are_not_idempotent(clock):
+    limiter = RateLimiter("test", 6000, max_retries=3)
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise ServiceError(503)
+
+    with pytest.raises(ServiceError):
+        limiter.call(fn, idempotent=False)
+    assert len(calls) == 1
+    with pytest.raises(ServiceError):
+        limiter.call(fn)
+    assert len(calls) == 1 + 4
+
+
+def test_identical_reads_in_flight_share_one_request():
+    limiter = RateLimiter("test", 6000)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fn(key):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        return f"value of {key}"
+
+    results = []
+    owner = threading.Thread(target=lambda: results.append(limiter.call(fn, "a", coalesce_key=("get", "a"))))
+    owner.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(limiter.call(fn, "a", coalesce_key=("get", "a"))))
+                 for _ in range(3)]
+    for t in followers:
+        t.start()
+    while limiter.stats().get("coalesced", 0) < 3:
+        threading.Event().wait(0.01)
+    release.set()
+    for t in [owner] + followers:
+        t.join(5)
+
+    assert calls == ["a"]
+    assert results == ["value of a"] * 4
+    assert limiter.call(fn, "a", coalesce_key=("get", "a")) == "value of a"
+    assert calls == ["a", "a"]
+
+
+def test_sheets_client_leaves_retries_to_the_limiter(tmp_path, fake_sheets):
+    SheetUploader(make_config(tmp_path)).connect()
+
+    assert fake_sheets.sheet.retries == 0
+    assert fake_sheets.sheet.check is False
@@ -0,0 +1,111 @@
+import datetime as dt
+
+import pytest
+
+import sheet_uploader
+from sheet_uploader import SheetUploader, DF_COLUMNS, PRICE_TO_SHARE_FORMULA
+from conftest import TEMPLATE_SHEET_ID, CHECKING_HEADER, CARD_HEADER, make_config
+
+
+def write(directory, name, content):
+    (directory / name).write_text(content)
+
+
+def values(row):
+    return [cell.get("userEnteredValue") for cell in row["values"]]
+
+
+def test_month_statements_are_uploaded_to_a_new_tab(tmp_path, fake_sheets):
+    write(tmp_path, "Chase0123_Activity20200201_20200229_20200301.CSV", CHECKING_HEADER +
+          "DEBIT,02/10/2020,RENT,-1500.00,ACH_DEBIT,100.00,\n")
+    # spans the whole year, only the february rows are uploaded
+    write(tmp_path, "Chase4567_Activity20200101_20201231_20210101.CSV", CARD_HEADER +
+          "03/02/2020,03/03/2020,OUT OF PERIOD,Shopping,Sale,-20.00,\n"
+          "02/03/2020,02/04/2020,COFFEE,Food & Drink,Sale,-4.50,\n")
+
+    sheet = SheetUploader(make_config(tmp_path)).upload_statements(dt.datetime(2020, 2, 1), dt.datetime(2020, 2, 29))
+
+    assert sheet.title == "Feb 2020"
+    [requests] = fake_sheets.sheet.batch_updates
+    duplicate = requests[0]["duplicateSheet"]
+    assert (duplicate["sourceSheetId"], duplicate["newSheetName"], duplicate["insertSheetIndex"]) == (TEMPLATE_SHEET_ID, "Feb 2020", 0)
+    header, *rows = requests[-1]["updateCells"]["rows"]
+    assert values(header) == [{"stringValue": col} for col in DF_COLUMNS]
+    assert [values(row) for row in rows] == [
+        [{"stringValue": "chk-0123"}, {"numberValue": 43871}, {"stringValue": "RENT"}, {"stringValue": "ach debit"},
+         {"numberValue": 1500.0}, {"numberValue": 0.0}, {"formulaValue": PRICE_TO_SHARE_FORMULA}],
+        [{"stringValue": "card-4567"}, {"numberValue": 43864}, {"stringValue": "COFFEE"}, {"stringValue": "Food & Drink"},
+         {"numberValue": 4.5}, {"numberValue": 0.0}, None],
+    ]
+    assert rows[0]["values"][1]["userEnteredFormat"]["numberFormat"]["type"] == "DATE"
+
+
+def test_update_appends_missing_rows_and_fixes_prices(tmp_path, fake_sheets):
+    write(tmp_path, "Chase4567_Activity20200201_20200229_20200301.CSV", CARD_HEADER +
+          "02/03/2020,02/04/2020,COFFEE,Food & Drink,Sale,-4.50,\n"
+          "02/05/2020,02/06/2020,BOOKS,Shopping,Sale,-12.00,\n"
+          "02/07/2020,02/08/2020,TRAIN,Travel,Sale,-30.00,\n")
+    fake_sheets.add_worksheet({"sheetId": 2, "title": "Feb 2020", "index": 0})
+    # dates come back as serial days, whatever format the user gave the column
+    fake_sheets.sheet.values["Feb 2020"] = [
+        DF_COLUMNS,
+        ["card-4567", 43864, "COFFEE", "Food & Drink", 4.5, 1, 4.5],
+        ["card-4567", 43866, "BOOKS", "Shopping", 10, 0.5, 5],
+    ]
+
+    uploader = SheetUploader(make_config(tmp_path))
+    sheet = uploader.upload_statements(dt.datetime(2020, 2, 1), dt.datetime(2020, 2, 29), update=True)
+
+    assert sheet.title == "Feb 2020"
+    [(_, options)] = fake_sheets.sheet.values_gets
+    assert options["date_time_render_option"].name == "SERIAL_NUMBER"
+    [requests] = fake_sheets.sheet.batch_updates
+    updates = [r["updateCells"] for r in requests if "updateCells" in r]
+    appended, price, formula = updates
+    assert appended["start"]["rowIndex"] == 3
+    assert [values(row)[2] for row in appended["rows"]] == [{"stringValue": "TRAIN"}]
+    assert (price["start"]["rowIndex"], values(price["rows"][0])) == (2, [{"numberValue": 12.0}])
+    assert values(formula["rows"][0]) == [{"formulaValue": PRICE_TO_SHARE_FORMULA}]
+
+
+def test_empty_month_uploads_the_header_only(tmp_path, fake_sheets):
+    sheet = SheetUploader(make_config(tmp_path)).upload_statements(dt.datetime(2020, 2, 1), dt.datetime(2020, 2, 29))
+
+    assert sheet.title == "Feb 2020"
+    header, *rows = fake_sheets.sheet.batch_updates[0][-1]["updateCells"]["rows"]
+    assert values(header) == [{"stringValue": col} for col in DF_COLUMNS]
+    assert rows == []
+
+
+def test_month_tab_is_the_newest_copy_when_the_original_is_gone(tmp_path, fake_sheets):
+    # uploads insert their tab at index 0
+    fake_sheets.add_worksheet({"sheetId": 2, "title": "Feb 2020_20200302_100000", "index": 0})
+    fake_sheets.add_worksheet({"sheetId": 3, "title": "Feb 2020_20200301_100000", "index": 1})
+    fake_sheets.add_worksheet({"sheetId": 4, "title": "Jan 2020", "index": 2})
+
+    sheet = SheetUploader(make_config(tmp_path)).find_month_sheet(dt.datetime(2020, 2, 1))
+
+    assert sheet.title == "Feb 2020_20200302_100000"
+
+
+def test_failed_upload_deletes_the_partially_filled_tab(tmp_path, fake_sheets, monkeypatch):
+    write(tmp_path, "Chase4567_Activity20200201_20200229_20200301.CSV", CARD_HEADER +
+          "02/03/2020,02/04/2020,COFFEE,Food & Drink,Sale,-4.50,\n"
+          "02/05/2020,02/06/2020,BOOKS,Shopping,Sale,-12.00,\n")
+    monkeypatch.setattr(sheet_uploader, "UPLOAD_BATCH_ROWS", 2)
+    batch_update = fake_sheets.sheet.batch_update
+
+    def fail_second_batch(spreadsheet_id, requests):
+        if len(fake_sheets.sheet.batch_updates) == 1:
+            fake_sheets.sheet.batch_updates.append(requests)
+            raise ConnectionError("connection reset")
+        return batch_update(spreadsheet_id, requests)
+    monkeypatch.setattr(fake_sheets.sheet, "batch_update", fail_second_batch)
+
+    with pytest.raises(ConnectionError):
+        SheetUploader(make_config(tmp_path)).upload_statements(dt.datetime(2020, 2, 1), dt.datetime(2020, 2, 29))
+
+    first, second, rollback = fake_sheets.sheet.batch_updates
+    sheet_id = first[0]["duplicateSheet"]["newSheetId"]
+    assert second[0]["updateCells"]["start"]["rowIndex"] == 2
+    assert rollback == [{"deleteSheet": {"sheetId": sheet_id}}]
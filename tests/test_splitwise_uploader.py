@@ -0,0 +1,84 @@
+import time
+import types
+import datetime as dt
+
+import pytest
+
+from splitwise_uploader import GroupPusher, expense_key
+
+
+class FakeExpense:
+    def __init__(self, description, date, cost, deleted_at=None):
+        self.description, self.date, self.cost, self.deleted_at = description, date, cost, deleted_at
+
+    def getDescription(self):
+        return self.description
+
+    def getDate(self):
+        return self.date
+
+    def getCost(self):
+        return self.cost
+
+    def getDeletedAt(self):
+        return self.deleted_at
+
+
+class FakeSplitwise:
+    # the group expenses are stored in UTC, as splitwise returns them
+    def __init__(self):
+        self.expenses = []
+        self.created = []
+        self.members = [types.SimpleNamespace(id=1), types.SimpleNamespace(id=2)]
+
+    def getCurrentUser(self):
+        return self.members[0]
+
+    def getGroup(self, group_id):
+        return types.SimpleNamespace(name="flat", members=self.members, getMembers=lambda: self.members)
+
+    def getExpenses(self, offset, limit, group_id, dated_after, dated_before):
+        return self.expenses[offset:offset + limit]
+
+    def createExpense(self, expense):
+        stored = dt.datetime.fromisoformat(expense.date).astimezone(dt.timezone.utc)
+        self.expenses.append(FakeExpense(expense.description, f"{stored:%Y-%m-%dT%H:%M:%SZ}", expense.cost))
+        self.created.append(expense)
+        return expense, None
+
+
+@pytest.fixture
+def new_york(monkeypatch):
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_splitwise_dates_are_compared_as_local_dates(new_york):
+    assert expense_key("rent", "2020-02-04T03:00:00Z", "1500.0") == expense_key("rent", dt.datetime(2020, 2, 3), 1500)
+    assert expense_key("rent", "2020-02-03T12:00:00Z", "1500.0") == expense_key("rent", dt.date(2020, 2, 3), 1500)
+
+
+def test_created_expenses_are_found_again_in_any_timezone(new_york):
+    sw = FakeSplitwise()
+    pusher = GroupPusher(sw, 42)
+    expenses = [("Feb 2020 - Rides", 30., dt.datetime(2020, 2, 29))]
+
+    assert pusher.push(expenses)["created"] == 1
+    assert pusher.push(expenses)["skipped"] == 1
+    assert len(sw.created) == 1
+
+
+def test_each_push_reads_the_group_expenses_again(new_york):
+    sw = FakeSplitwise()
+    pusher = GroupPusher(sw, 42)
+    expenses = [("Feb 2020 - Food", 12.5, dt.datetime(2020, 2, 29))]
+    pusher.push(expenses)
+
+    sw.expenses[0].deleted_at = "2020-03-02T10:00:00Z"
+    assert pusher.push(expenses)["created"] == 1
+
+    sw.expenses.append(FakeExpense("Feb 2020 - Rides", "2020-02-29T17:00:00Z", "8.0"))
+    assert pusher.push([("Feb 2020 - Rides", 8, dt.datetime(2020, 2, 29))])["skipped"] == 1
@@ -0,0 +1,59 @@
+import os
+import datetime as dt
+
+from statement_index import StatementIndex
+from conftest import CHECKING, CARD, CHECKING_HEADER, CARD_HEADER
+
+
+def write(directory, name, content, mtime=None):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(content)
+    if mtime:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def checking_rows(*dates):
+    return CHECKING_HEADER + "".join(f"DEBIT,{d},SHOP,-1.00,DEBIT_CARD,10.00,\n" for d in dates)
+
+
+def test_exact_range_wins_over_covering_file(tmp_path):
+    write(tmp_path, "Chase4567_Activity20200101_20201231_20210101.CSV", CARD_HEADER)
+    exact = write(tmp_path, "Chase4567_Activity20200201_20200229_20200301.CSV", CARD_HEADER)
+    index = StatementIndex(str(tmp_path))
+    assert index.find(CARD, dt.datetime(2020, 2, 1), dt.datetime(2020, 2, 29)).path == exact
+
+
+def test_covering_file_is_used_when_no_exact_range(tmp_path):
+    year = write(tmp_path, "Chase4567_Activity20200101_20201231_20210101.CSV", CARD_HEADER)
+    index = StatementIndex(str(tmp_path))
+    assert index.find(CARD, dt.datetime(2020, 3, 1), dt.datetime(2020, 3, 31)).path == year
+    assert index.find(CARD, dt.datetime(2021, 3, 1), dt.datetime(2021, 3, 31)) is None
+
+
+def test_newest_copy_of_a_range_wins(tmp_path):
+    write(tmp_path, "Chase4567_Activity20200201_20200229_20200301.CSV", CARD_HEADER)
+    copy = write(tmp_path, "Chase4567_Activity20200201_20200229_20200301 (1).CSV", CARD_HEADER)
+    index = StatementIndex(str(tmp_path))
+    assert index.find(CARD, dt.datetime(2020, 2, 1), dt.datetime(2020, 2, 29)).path == copy
+
+
+def test_checking_file_without_range_is_picked_by_content(tmp_path):
+    february = write(tmp_path, "Chase0123_Activity_20200301.CSV", checking_rows("02/03/2020", "02/27/2020"), mtime=1000)
+    march = write(tmp_path, "Chase0123_Activity_20200301 (1).CSV", checking_rows("03/02/2020", "03/30/2020"), mtime=2000)
+    index = StatementIndex(str(tmp_path))
+    # the newest download is another month's, it must not be clipped to february
+    assert index.find(CHECKING, dt.datetime(2020, 2, 1), dt.datetime(2020, 2, 29)).path == february
+    assert index.find(CHECKING, dt.datetime(2020, 3, 1), dt.datetime(2020, 3, 31)).path == march
+    assert index.find(CHECKING, dt.datetime(2020, 4, 1), dt.datetime(2020, 4, 30)) is None
+
+
+def test_index_follows_the_directory(tmp_path):
+    index = StatementIndex(str(tmp_path))
+    assert index.files() == []
+    path = write(tmp_path, "Chase4567_Activity20200201_20200229_20200301.CSV", CARD_HEADER)
+    # the directory mtime may not move within the same tick
+    os.utime(tmp_path, (os.stat(tmp_path).st_mtime + 1,) * 2)
+    assert [f.path for f in index.files(CARD)] == [path]
+    assert index.files(CHECKING) == []
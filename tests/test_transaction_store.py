@@ -0,0 +1,69 @@
+import datetime as dt
+
+import pandas as pd
+
+from transaction_store import TransactionStore, transaction_fingerprints
+
+
+def chunk(rows):
+    return pd.DataFrame([("card-4567", pd.Timestamp(date), item, "Shopping", price) for date, item, price in rows],
+                        columns=["account", "date", "item", "category", "price"])
+
+
+def statement_file(directory, name):
+    path = directory / name
+    path.write_text(name)
+    return str(path)
+
+
+def stored_items(store):
+    return sorted(store.transactions(dt.datetime(2020, 1, 1), dt.datetime(2020, 12, 31))["item"])
+
+
+def test_transactions_of_overlapping_statements_are_stored_once(tmp_path):
+    store = TransactionStore(str(tmp_path / "transactions.sqlite3"))
+    january = chunk([("2020-01-10", "COFFEE", 4.5), ("2020-01-20", "BOOKS", 12.)])
+    mid_month = chunk([("2020-01-20", "BOOKS", 12.), ("2020-02-05", "TRAIN", 30.)])
+
+    assert store.ingest(statement_file(tmp_path, "january.CSV"), "card", [january]) == 2
+    assert store.ingest(statement_file(tmp_path, "mid_month.CSV"), "card", [mid_month]) == 1
+
+    assert stored_items(store) == ["BOOKS", "COFFEE", "TRAIN"]
+
+
+def test_identical_purchases_of_the_same_day_are_kept(tmp_path):
+    store = TransactionStore(str(tmp_path / "transactions.sqlite3"))
+    rows = [("2020-01-10", "COFFEE", 4.5), ("2020-01-10", "COFFEE", 4.5)]
+
+    store.ingest(statement_file(tmp_path, "january.CSV"), "card", [chunk(rows)])
+    # the same two purchases found again in an overlapping statement
+    store.ingest(statement_file(tmp_path, "overlap.CSV"), "card", [chunk(rows + [("2020-01-11", "TEA", 3.)])])
+
+    assert stored_items(store) == ["COFFEE", "COFFEE", "TEA"]
+
+
+def test_fingerprints_do_not_depend_on_the_chunk_size():
+    df = chunk([("2020-01-10", "COFFEE", 4.5), ("2020-01-10", "COFFEE", 4.5), ("2020-01-11", "TEA", 3.),
+                ("2020-01-10", "COFFEE", 4.5), ("2020-01-11", "TEA", 3.)])
+    whole = transaction_fingerprints(df["account"], df["date"], df["item"], df["price"])
+    assert len(set(whole)) == len(df)
+
+    for size in (1, 2, 3):
+        seen = {}
+        chunked = []
+        for start in range(0, len(df), size):
+            part = df.iloc[start:start + size]
+            chunked.extend(transaction_fingerprints(part["account"], part["date"], part["item"], part["price"], seen))
+        assert chunked == list(whole)
+
+
+def test_file_is_ingested_again_once_modified(tmp_path):
+    store = TransactionStore(str(tmp_path / "transactions.sqlite3"))
+    path = statement_file(tmp_path, "january.CSV")
+    store.ingest(path, "card", [chunk([("2020-01-10", "COFFEE", 4.5)])])
+    assert store.is_ingested(path, "card")
+    assert not store.is_ingested(path, "checking")
+
+    with open(path, "a") as f:
+        f.write("more rows")
+    assert not store.is_ingested(path, "card")
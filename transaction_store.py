@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import logging
+import threading
+import datetime as dt
+import pandas as pd
+
+STORE_COLUMNS = ["fingerprint", "account", "date", "item", "category", "price"]
+STORE_DATE_FORMAT = '%Y-%m-%d'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    fingerprint INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    date TEXT NOT NULL,
+    item TEXT,
+    category TEXT,
+    price REAL NOT NULL,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS transactions_account_date ON transactions (account, date);
+CREATE INDEX IF NOT EXISTS transactions_date ON transactions (date);
+CREATE TABLE IF NOT EXISTS ingested_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    variant TEXT NOT NULL,
+    nb_rows INTEGER NOT NULL,
+    ingested_at TEXT NOT NULL
+);
+"""
+
+
+def transaction_fingerprints(account, date, item, price, seen=None):
+    # stable 64 bits hash of the transaction, the occurrence number tells apart identical purchases made the same day.
+    # seen carries the occurrences counted in previous chunks of the same file
+    keys = pd.DataFrame({
+        "account": pd.Series(account, dtype='object').astype(str).values,
+        "date": pd.to_datetime(pd.Series(date)).dt.strftime(STORE_DATE_FORMAT).values,
+        "item": pd.Series(item, dtype='object').astype(str).values,
+        "price": pd.Series(price).astype('float64').round(2).values,
+    })
+    base = pd.Series(pd.util.hash_pandas_object(keys, index=False).values)
+    occurrence = base.groupby(base, sort=False).cumcount()
+    if seen is not None:
+        occurrence += base.map(seen).fillna(0).astype('int64')
+        for key, count in base.value_counts().items():
+            seen[key] = seen.get(key, 0) + count
+    keys["occurrence"] = occurrence.values
+    return pd.util.hash_pandas_object(keys, index=False).values.view('int64')
+
+
+class TransactionStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def is_ingested(self, path, variant):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            row = self._conn.execute("SELECT size, mtime_ns, variant FROM ingested_files WHERE path = ?",
+                                     (os.path.abspath(path),)).fetchone()
+        return row == (st.st_size, st.st_mtime_ns, variant)
+
+    def ingest(self, path, variant, chunks):
+        # chunks are frames with account, date, item, category and price columns, all written in one transaction
+        st = os.stat(path)
+        source = os.path.basename(path)
+        seen = {}
+        nb_rows = 0
+        with self._lock, self._conn:
+            before = self._conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+            for chunk in chunks:
+                rows = self._to_rows(chunk, seen)
+                nb_rows += len(rows)
+                self._conn.executemany(
+                    "INSERT INTO transactions (fingerprint, account, date, item, category, price, source) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (fingerprint) DO UPDATE SET category = excluded.category, source = excluded.source",
+                    ((int(r[0]), r[1], r[2], r[3], r[4], float(r[5]), source) for r in rows.itertuples(index=False)))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ingested_files (path, size, mtime_ns, variant, nb_rows, ingested_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(path), st.st_size, st.st_mtime_ns, variant, nb_rows, dt.datetime.now().isoformat()))
+            added = self._conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0] - before
+        logging.info(f"Ingested {source}: {added} new transaction(s) out of {nb_rows}")
+        return added
+
+    @staticmethod
+    def _to_rows(chunk, seen):
+        return pd.DataFrame({
+            "fingerprint": transaction_fingerprints(chunk["account"], chunk["date"], chunk["item"], chunk["price"], seen),
+            "account": chunk["account"].astype('object').astype(str).values,
+            "date": pd.to_datetime(chunk["date"]).dt.strftime(STORE_DATE_FORMAT).values,
+            "item": chunk["item"].astype('object').astype(str).values,
+            "category": chunk["category"].astype('object').astype(str).values,
+            "price": chunk["price"].astype('float64').round(2).values,
+        })
+
+    def transactions(self, date_from: dt.datetime, date_to: dt.datetime, accounts=None):
+        query = f"SELECT {', '.join(STORE_COLUMNS)} FROM transactions WHERE date BETWEEN ? AND ?"
+        params = [f"{date_from:{STORE_DATE_FORMAT}}", f"{date_to:{STORE_DATE_FORMAT}}"]
+        if accounts is not None:
+            accounts = [str(a) for a in accounts]
+            query += f" AND account IN ({', '.join('?' * len(accounts))})"
+            params += accounts
+        query += " ORDER BY account, date"
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return pd.DataFrame.from_records(rows, columns=STORE_COLUMNS)
+
+
+def get_transaction_store(config):
+    if not config.transaction_store_path:
+        return None
+    return TransactionStore(config.transaction_store_path)